@@ -4,6 +4,7 @@
 __version__ = "1.0.8"
 
 import sys
+import contextlib
 #from threading import Thread, Event
 if sys.version_info.major >= 3:
 #	from queue import Queue
@@ -13,34 +14,89 @@ else:
 #	from Queue import Queue
 	from StringIO import StringIO
 	from types import StringTypes
-from time import sleep
+from time import sleep, monotonic
 import signal
-import termios, os, fcntl, atexit, select, locale
+import termios, os, fcntl, atexit, select, locale, re, functools, codecs, itertools, math
+import wcwidth
 
 class NoKeyPressed(Exception):
 	pass
 
+# Precomputed escape sequences, so that the rendering hot paths don't need to
+# go through jlib.encapsulate_ansi() and .encode() on every call.
+ansi_bytes = {
+	'erase_line':                  b"\x1b[2K",
+	'erase_line_from_cursor':      b"\x1b[K",
+	'erase_below':                 b"\x1b[J",
+	'erase_screen':                b"\x1b[2J",
+	'erase_screen_and_scrollback': b"\x1b[3J",
+	'disable_line_wrap':           b"\x1b[?7l",
+	'enable_line_wrap':            b"\x1b[?7h",
+	'disable_cursor':              b"\x1b[?25l",
+	'enable_cursor':               b"\x1b[?25h",
+	'disable_bracketed_paste':     b"\x1b[?2004l",
+	'enable_bracketed_paste':      b"\x1b[?2004h",
+	'status':                      b"\x1b[6n",
+	'color_normal':                b"\x1b[0m",
+}
+# Common combinations.
+ansi_bytes['clear_line'] = ansi_bytes['erase_line'] + b"\x1b[1G"
+ansi_bytes['clear_line_nowrap'] = ansi_bytes['clear_line'] + ansi_bytes['disable_line_wrap']
+
+# Final bytes for the parameterized sequences ansi_param() knows how to build.
+_ansi_param_finals = {
+	'cursor_up':                  'A',
+	'cursor_down':                'B',
+	'cursor_horizontal_absolute': 'G',
+	'cursor_position':            'H',
+}
+
+@functools.lru_cache(maxsize=1024)
+def ansi_param(name, *params):
+	"""
+	Returns the bytes for a parameterized escape sequence, such as
+	ansi_param('cursor_horizontal_absolute', 10). Results are memoized.
+	"""
+	return "\x1b[{}{}".format(';'.join([ str(x) for x in params ]), _ansi_param_finals[name]).encode()
+
+# Matches any single escape sequence (CSI or two-character) in a string.
+_esc_pat = re.compile('\x1b(?:\\[[0-?]*[ -/]*[@-~]|[@-Z\\\\-_])')
+_sgr_pat = re.compile('^\x1b\\[[0-9;]*m$')
+
 # Hook for capturing "Window change" signals.
 # Install this by calling:
 # signal.signal(signal.SIGWINCH, sigwinchHook)
 def sigwinchHook(signum, frame):
 	try:
 		Term.getSize()
+		gradient_palette.cache_clear()
 		DotPrinterSlots.lock()
-		DotPrinterSlots.refresh()
-		DotPrinterSlots.release()
+		try:
+			DotPrinterSlots.refresh()
+		finally:
+			DotPrinterSlots.release()
 	except:
 		pass
 
 def textwidth(text):
 	"""
 	Returns the number of columns a given amount of text will take up,
-	taking ANSI color escape sequences and dual-width characters
-	into account.
+	taking ANSI escape sequences and dual-width characters into account.
+
+	Plain printable ASCII is measured directly. Anything else goes through
+	a bounded LRU cache; textwidth.cache_info() reports its hits and misses,
+	and textwidth.cache_clear() empties it.
 	"""
-	# Note: module "colors" is provided by the "ansicolors" package in pip.
-	import colors, wcwidth
-	return wcwidth.wcswidth(colors.strip_color(text))
+	if text.isascii() and text.isprintable():
+		return len(text)
+	return _textwidth(text)
+
+@functools.lru_cache(maxsize=65536)
+def _textwidth(text):
+	return wcwidth.wcswidth(_esc_pat.sub('', text))
+
+textwidth.cache_info = _textwidth.cache_info
+textwidth.cache_clear = _textwidth.cache_clear
 
 def center(text, width, fillchar=' '):# {{{
 	twidth = textwidth(text)
@@ -64,6 +120,39 @@ def rjust(text, width, fillchar=' '):# {{{
 	pad = width - twidth
 	return (fillchar * pad) + text
 # }}}
+def textwidths(texts):# {{{
+	"""
+	Returns a list of the textwidth() of each string in texts, computed
+	in a single pass.
+	"""
+	return [ len(x) if x.isascii() and x.isprintable() else _textwidth(x) for x in texts ]
+# }}}
+def justify_column(texts, width=None, justify="left", fillchar=' '):# {{{
+	"""
+	Justifies a whole column of strings at once, returning a list of the
+	padded strings. Works like ljust(), rjust() or center() (depending on
+	justify, which can be "left", "right" or "center") applied to each
+	string, except that all widths are measured in one go. If width is
+	None, the column is made as wide as its widest string.
+	"""
+	widths = textwidths(texts)
+	if width is None:
+		width = max(widths, default=0)
+	if justify == "left":
+		return [ text + (fillchar * (width - twidth)) if twidth < width else text for text, twidth in zip(texts, widths) ]
+	elif justify == "right":
+		return [ (fillchar * (width - twidth)) + text if twidth < width else text for text, twidth in zip(texts, widths) ]
+	elif justify == "center":
+		ret = []
+		for text, twidth in zip(texts, widths):
+			if twidth >= width:
+				ret.append(text)
+			else:
+				lhs_pad = round((width - twidth) / 2)
+				ret.append((fillchar * lhs_pad) + text + (fillchar * (width - (lhs_pad + twidth))))
+		return ret
+	raise ValueError('only "left", "right" and "center" are valid arguments for the justify argument')
+# }}}
 
 
 class Term:# {{{
@@ -73,14 +162,29 @@ class Term:# {{{
 	"""
 	# Remember, these go COLS then ROWS
 	size = (0, 0)
+	# If set, getSize() reports this instead of asking the terminal. Used
+	# for output targets that aren't real terminals. See setOutput().
+	fixed_size = None
 	_sizeChanged = False
 	fd = None
+	# Where output goes. Set by init() or setOutput().
+	stdout = None
+	stderr = None
 	origattrs = None
 	cursor_enabled = True
+	bracketed_paste = False
 	advanced_pos = None
 	advanced_lut = None
 	fl = None
 	initialized = False
+	# Raw input session state. See beginRawInput().
+	raw_depth = 0
+	raw_attrs = None
+	# Input read in bulk during a raw input session, waiting to be handed
+	# out by getkey(). inpos is how much of it has been handed out.
+	inbuf = b''
+	inpos = 0
+	read_size = 4096
 	# Initialization function.  For best results, call this
 	# before any other classmethods.
 	@classmethod
@@ -89,14 +193,14 @@ class Term:# {{{
 			signal.signal(signal.SIGWINCH, sigwinchHook)
 			cls.getSize()
 			cls.stdin  = stdin
-			if stdout is None:
-				cls.stdout = sys.stdout.buffer
-			else:
+			if stdout is not None:
 				cls.stdout = stdout
-			if stderr is None:
-				cls.stderr = sys.stderr.buffer
-			else:
+			elif cls.stdout is None:
+				cls.stdout = sys.stdout.buffer
+			if stderr is not None:
 				cls.stderr = stderr
+			elif cls.stderr is None:
+				cls.stderr = sys.stderr.buffer
 			cls.fd = stdin.fileno()
 			atexit.register(Term.cleanup)
 		if cls.origattrs is None:
@@ -113,6 +217,27 @@ class Term:# {{{
 		if cls.fl is None:
 			cls.fl = fcntl.fcntl(cls.fd, fcntl.F_GETFL)
 		cls.initialized = True
+	# Sends all output somewhere other than sys.stdout/sys.stderr, such as
+	# a ByteSink or VirtualTerminal. stdout defaults to the same target as
+	# stderr, which is how things are when both go to the same terminal.
+	# If the target has a size attribute, it's used as the terminal size.
+	@classmethod
+	def setOutput(cls, stderr, stdout=None):
+		if stdout is None:
+			stdout = stderr
+		cls.stdout = stdout
+		cls.stderr = stderr
+		cls.fixed_size = getattr(stderr, 'size', None)
+		if cls.fixed_size is not None:
+			cls.size = cls.fixed_size
+		DotPrinterSlots.retarget()
+	# The file object that escape sequences get written to: Term.stderr,
+	# or sys.stderr if init() hasn't been called yet.
+	@classmethod
+	def output(cls):
+		if cls.stderr is not None:
+			return cls.stderr
+		return sys.stderr.buffer
 	# Puts terminal in 'raw' mode.
 	@classmethod
 	def raw(cls):
@@ -166,34 +291,64 @@ class Term:# {{{
 		new[3] = new[3] & ~termios.ISIG
 		termios.tcsetattr(cls.fd, termios.TCSANOW, new)
 	# Turns off the cursor.
+	# outfile defaults to Term.output().
 	@classmethod
-	def disableCursor(cls):
-		sys.stderr.buffer.write(b"\x1b[?25l")
-		sys.stderr.buffer.flush()
+	def disableCursor(cls, outfile=None):
+		if outfile is None:
+			outfile = cls.output()
+		outfile.write(ansi_bytes['disable_cursor'])
+		outfile.flush()
 		cls.cursor_enabled = False
 	# Turns on the cursor.
+	# outfile defaults to Term.output().
 	@classmethod
-	def enableCursor(cls):
-		sys.stderr.buffer.write(b"\x1b[?25h")
-		sys.stderr.buffer.flush()
+	def enableCursor(cls, outfile=None):
+		if outfile is None:
+			outfile = cls.output()
+		outfile.write(ansi_bytes['enable_cursor'])
+		outfile.flush()
 		cls.cursor_enabled = True
+	# Asks the terminal to wrap anything pasted into it with ESC [ 200 ~
+	# and ESC [ 201 ~, so it can be told apart from typing (see the Paste
+	# class).
+	# outfile defaults to Term.output().
+	@classmethod
+	def enableBracketedPaste(cls, outfile=None):
+		if outfile is None:
+			outfile = cls.output()
+		outfile.write(ansi_bytes['enable_bracketed_paste'])
+		outfile.flush()
+		cls.bracketed_paste = True
+	# Turns bracketed paste back off.
+	# outfile defaults to Term.output().
+	@classmethod
+	def disableBracketedPaste(cls, outfile=None):
+		if outfile is None:
+			outfile = cls.output()
+		outfile.write(ansi_bytes['disable_bracketed_paste'])
+		outfile.flush()
+		cls.bracketed_paste = False
 	# Reverts any changes made to the terminal.
 	# Automatically called at script termination (provided you called init())
 	@classmethod
 	def cleanup(cls):
 		if cls.origattrs is not None:
-			termios.tcsetattr(cls.fd, termios.TCSAFLUSH, cls.origattrs)
+			try:
+				termios.tcsetattr(cls.fd, termios.TCSAFLUSH, cls.origattrs)
+			except termios.error:
+				pass
+		if cls.bracketed_paste:
+			cls.disableBracketedPaste()
 		cls.enableCursor()
 	@classmethod
 	def getCursor(cls):
-		import jlib
 		if not cls.initialized:
 			cls.init()
 		blocking = cls.getblocking()
 		if not blocking:
 			cls.setblocking(True)
-		sys.stderr.buffer.write(jlib.encapsulate_ansi('status').encode())
-		sys.stderr.buffer.flush()
+		cls.output().write(ansi_bytes['status'])
+		cls.output().flush()
 		retbuf = b''
 		while True:
 			char = cls.getkey()
@@ -208,11 +363,96 @@ class Term:# {{{
 		return col, row
 	@classmethod
 	def setCursor(cls, col, row, flush=True):
-		import jlib
-		sys.stderr.buffer.write(jlib.encapsulate_ansi('cursor_position', [ "{}".format(x) for x in [row, col] ]).encode())
-
+		cls.output().write(ansi_param('cursor_position', row, col))
 		if flush:
-			sys.stderr.buffer.flush()
+			cls.output().flush()
+	# Starts a raw input session: the terminal is put into non-canonical,
+	# no-echo, no-signal mode once, and stays that way until the matching
+	# endRawInput() call. While a session is active, getkey() reads input
+	# in bulk and hands it out from a buffer, instead of flipping the
+	# terminal mode and making a read() call for every byte.
+	# Sessions nest; only the outermost one touches the terminal mode.
+	@classmethod
+	def beginRawInput(cls):
+		if not cls.initialized:
+			cls.init()
+		cls.raw_depth += 1
+		if cls.raw_depth > 1:
+			return
+		try:
+			cls.raw_attrs = termios.tcgetattr(cls.fd)
+		except termios.error:
+			cls.raw_attrs = None
+			return
+		new = termios.tcgetattr(cls.fd)
+		new[3] = new[3] & ~termios.ICANON & ~termios.ECHO & ~termios.ISIG
+		new[6][termios.VMIN] = 1
+		new[6][termios.VTIME] = 0
+		termios.tcsetattr(cls.fd, termios.TCSANOW, new)
+	# Ends a raw input session, restoring the terminal mode that was in
+	# effect when it began.
+	@classmethod
+	def endRawInput(cls):
+		if cls.raw_depth < 1:
+			return
+		cls.raw_depth -= 1
+		if cls.raw_depth == 0 and cls.raw_attrs is not None:
+			try:
+				termios.tcsetattr(cls.fd, termios.TCSANOW, cls.raw_attrs)
+			except termios.error:
+				pass
+			cls.raw_attrs = None
+	# Context manager version of beginRawInput()/endRawInput():
+	#	with Term.rawInput():
+	#		key = Term.getkey()
+	@classmethod
+	@contextlib.contextmanager
+	def rawInput(cls):
+		cls.beginRawInput()
+		try:
+			yield
+		finally:
+			cls.endRawInput()
+	# Returns the number of bytes read from the terminal that haven't been
+	# handed out yet. Keep in mind select() on stdin won't know about these.
+	@classmethod
+	def pending(cls):
+		return len(cls.inbuf) - cls.inpos
+	# Returns everything buffered so far, or, if nothing is buffered, the
+	# result of a single read() of up to read_size bytes. Blocking
+	# behavior is the same as getkey(). If interruptable is True, input is
+	# returned up to a ^C, and the call after that raises KeyboardInterrupt.
+	@classmethod
+	def getchunk(cls, interruptable=True):
+		if not cls.initialized:
+			cls.init()
+		if cls.pending() < 1:
+			cls.fillbuf()
+		data = cls.inbuf[cls.inpos:]
+		if interruptable:
+			idx = data.find(b'\x03')
+			if idx == 0:
+				cls.inpos += 1
+				raise KeyboardInterrupt
+			elif idx > 0:
+				data = data[:idx]
+		cls.inpos += len(data)
+		return data
+	@classmethod
+	def fillbuf(cls):
+		if cls.raw_depth > 0:
+			try:
+				data = os.read(cls.fd, cls.read_size)
+			except OSError:
+				raise NoKeyPressed
+		else:
+			with cls.rawInput():
+				try:
+					data = os.read(cls.fd, cls.read_size)
+				except OSError:
+					raise NoKeyPressed
+		cls.inbuf = cls.inbuf[cls.inpos:] + data
+		cls.inpos = 0
 	# Get one character from stdin.
 	# Set interruptable=false if you don't want ^C to work.
 	# By default, calling this blocks until a key is pressed. This behavior
@@ -223,6 +463,14 @@ class Term:# {{{
 	def getkey(cls, interruptable=True):
 		if not cls.initialized:
 			cls.init()
+		if cls.raw_depth > 0 or cls.pending() > 0:
+			if cls.pending() < 1:
+				cls.fillbuf()
+			c = cls.inbuf[cls.inpos:cls.inpos + 1]
+			cls.inpos += 1
+			if interruptable and c == b'\x03':
+				raise KeyboardInterrupt
+			return c
 		try:
 			orig = termios.tcgetattr(cls.fd)
 		except termios.error:
@@ -241,6 +489,62 @@ class Term:# {{{
 		if interruptable and c == b'\x03':
 			raise KeyboardInterrupt
 		return c
+	# Pushes data back onto the front of the input buffer, so that it will
+	# be handed out again by the next getkey()/getchunk().
+	@classmethod
+	def unget(cls, data):
+		if len(data) > 0:
+			cls.inbuf = data + cls.inbuf[cls.inpos:]
+			cls.inpos = 0
+	# asyncio version of waiting for select() to say fd (which defaults to
+	# the terminal) is readable. Uses loop.add_reader(), so nothing spins
+	# while we wait. Returns straight away if there's buffered input.
+	@classmethod
+	async def waitReadable(cls, fd=None):
+		import asyncio
+		if not cls.initialized:
+			cls.init()
+		if cls.pending() > 0:
+			return
+		if fd is None:
+			fd = cls.fd
+		loop = asyncio.get_running_loop()
+		fut = loop.create_future()
+		def ready():
+			if not fut.done():
+				fut.set_result(None)
+		loop.add_reader(fd, ready)
+		try:
+			await fut
+		finally:
+			loop.remove_reader(fd)
+	# asyncio version of getchunk(). Waits for input without blocking the
+	# event loop, then returns it. Call it during a raw input session, or
+	# the terminal will be line buffered.
+	@classmethod
+	async def getchunkAsync(cls, interruptable=True):
+		await cls.waitReadable()
+		return cls.getchunk(interruptable)
+	# Asynchronous iterator over terminal input, run through a
+	# TerminalSequenceParser (pass your own if you want a decoder on it).
+	# Keeps a raw input session going while it's being iterated over.
+	#	async for event in Term.keyEvents():
+	#		if event == frozenset({'f1'}):
+	#			...
+	# Events are the same as TerminalSequenceParser.parse() returns, so
+	# ordinary typing can come back several characters at a time.
+	@classmethod
+	async def keyEvents(cls, parser=None, interruptable=True):
+		if parser is None:
+			parser = TerminalSequenceParser()
+		cls.beginRawInput()
+		try:
+			while True:
+				data = await cls.getchunkAsync(interruptable)
+				for event in parser.parse(data):
+					yield event
+		finally:
+			cls.endRawInput()
 	# Okay, so this guy uses our big long list of terminal sequences.
 	# The trick is to keep calling it until you get a result that
 	# isn't None (or NoKeyPressed, if blocking is False).
@@ -250,7 +554,7 @@ class Term:# {{{
 	@classmethod
 	def getkey_advanced(cls, interruptable=True):
 		if cls.advanced_lut is None:
-			cls.advanced_lut = generate_terminal_code_lut()[0]
+			cls.advanced_lut = terminal_code_lut()[0]
 		if cls.advanced_pos is None:
 			cls.advanced_pos = cls.advanced_lut
 		key = cls.getkey(interruptable)
@@ -278,17 +582,18 @@ class Term:# {{{
 		return not cls.fl & os.O_NONBLOCK > 0
 	@classmethod
 	def clearLine(cls, flush=True):
-		import jlib
-		sys.stderr.buffer.write(jlib.encapsulate_ansi('erase_line').encode())
-		sys.stderr.buffer.write(jlib.encapsulate_ansi('cursor_horizontal_absolute', ['1']).encode())
+		cls.output().write(ansi_bytes['clear_line'])
 		if flush:
-			sys.stderr.buffer.flush()
+			cls.output().flush()
 
 	# originally from stackoverflow.com
 	# Poll the controlling terminal for its dimensions.
 	# This gets called automatically if the sigwinch hook is installed.
 	@classmethod
 	def getSize(cls):
+		if cls.fixed_size is not None:
+			cls.size = cls.fixed_size
+			return cls.size
 		def ioctl_GWINSZ(fd):
 			try:
 				import fcntl, termios, struct, os
@@ -320,41 +625,108 @@ class Term:# {{{
 		return False
 	@classmethod
 	def clear(cls, flush=True):
-		import jlib
-		sys.stderr.buffer.write(jlib.encapsulate_ansi('erase_screen').encode())
+		cls.output().write(ansi_bytes['erase_screen'])
 		if flush:
-			sys.stderr.buffer.flush()
+			cls.output().flush()
 	@classmethod
 	def clearScrollback(cls, flush=True):
-		import jlib
-		sys.stderr.buffer.write(jlib.encapsulate_ansi('erase_screen_and_scrollback').encode())
+		cls.output().write(ansi_bytes['erase_screen_and_scrollback'])
 		if flush:
-			sys.stderr.buffer.flush()
+			cls.output().flush()
 # }}}
 
+def stripAnsi(text):# {{{
+	"""
+	Returns text with any ANSI escape sequences removed.
+	"""
+	return _esc_pat.sub('', text)
+# }}}
+def ansi_tokens(text):# {{{
+	"""
+	Breaks text up into a list of (token, width) tuples, where each token
+	is either a single character or a whole escape sequence (which has a
+	width of 0).
+	"""
+	def add_chars(chunk):
+		if chunk.isascii() and chunk.isprintable():
+			tokens.extend(zip(chunk, itertools.repeat(1)))
+		else:
+			tokens.extend([ (ch, max(wcwidth.wcwidth(ch), 0)) for ch in chunk ])
+	tokens = []
+	pos = 0
+	for mat in _esc_pat.finditer(text):
+		add_chars(text[pos:mat.start()])
+		tokens.append((mat.group(0), 0))
+		pos = mat.end()
+	add_chars(text[pos:])
+	return tokens
+# }}}
+def _sgr_state(tokens):
+	# Returns the color escapes in effect after tokens.
+	state = []
+	for token, width in tokens:
+		if width == 0 and _sgr_pat.match(token) is not None:
+			if token in ('\x1b[m', '\x1b[0m'):
+				state = []
+			else:
+				state.append(token)
+	return ''.join(state)
+def _head_tokens(tokens, budget):
+	# Returns how many tokens from the front fit in budget columns.
+	used = 0
+	for idx in range(len(tokens)):
+		used += tokens[idx][1]
+		if used > budget:
+			return idx
+	return len(tokens)
+def _tail_tokens(tokens, budget):
+	# Returns the index of the first of the tokens at the end that fit in
+	# budget columns.
+	used = 0
+	for idx in range(len(tokens) - 1, -1, -1):
+		used += tokens[idx][1]
+		if used > budget:
+			return idx + 1
+	return 0
 def formatLine(txt, maxWidth, justify="left", moreString="$"):# {{{
+	"""
+	Clips txt to fit in maxWidth columns, marking the spot where text was
+	removed with moreString. justify controls which part is kept:
+
+	* "left" — the start of the line is kept, and moreString goes on the end.
+	* "right" — the end of the line is kept, and moreString goes at the start.
+	* "middle" — both ends are kept, with moreString in between.
+
+	Escape sequences don't count towards the width, double-width characters
+	count as two columns, and colors in effect at the cut are carried over
+	(and reset), so clipping doesn't bleed colors into moreString. The
+	string is only walked a couple of times, no matter how long it is.
+
+	If txt already fits, it's returned unaltered.
+	"""
 	# TODO: Figure out a way to account for tab width when sizing,
 	# but print tab characters instead of spaces.
 	# Problems arise when tab characters occur in the slice,
 	# so we just expand them.
-	# I think this strip() is causing size to be misreported, causing line overflow.
-	#newTxt = str(txt).strip().expandtabs()
-	# Ok, converting to a string makes unicode cry.
-	#newTxt = str(txt).expandtabs()
-	newTxt = txt.expandtabs()
-	if len(stripAnsi(newTxt)) > maxWidth:
-		maxWidth -= len(moreString)
-		while len(stripAnsi(newTxt)) > maxWidth:
-			newTxt = newTxt[:-1]
-		
-		if justify == "left":
-			return "{}{}".format(newTxt, moreString)
-		elif justify == "right":
-			return "{}{}".format(moreString, newTxt)
-		else:
-			raise ValueError('only "left" and "right" are valid arguments for the justify argument')
-
-	return txt
+	tokens = ansi_tokens(txt.expandtabs())
+	if sum([ x[1] for x in tokens ]) <= maxWidth:
+		return txt
+	budget = max(maxWidth - textwidth(moreString), 0)
+	reset = ansi_bytes['color_normal'].decode()
+	if justify == "left":
+		head = tokens[:_head_tokens(tokens, budget)]
+		state = _sgr_state(head)
+		return ''.join([ x[0] for x in head ]) + (reset if state else '') + moreString
+	elif justify == "right":
+		start = _tail_tokens(tokens, budget)
+		return moreString + _sgr_state(tokens[:start]) + ''.join([ x[0] for x in tokens[start:] ])
+	elif justify == "middle":
+		head = tokens[:_head_tokens(tokens, budget - (budget // 2))]
+		start = max(_tail_tokens(tokens, budget // 2), len(head))
+		state = _sgr_state(head)
+		return ''.join([ x[0] for x in head ]) + (reset if state else '') + moreString + _sgr_state(tokens[:start]) + ''.join([ x[0] for x in tokens[start:] ])
+	else:
+		raise ValueError('only "left", "right" and "middle" are valid arguments for the justify argument')
 		# }}}
 class DumLock:# {{{
 	def __init__(self):
@@ -396,6 +768,529 @@ class TeeWriter(object):# {{{
 	def flush(self):
 		sys.stdout.flush()
 # }}}
+def same_destination(a, b):# {{{
+	"""
+	Returns True if file objects a and b are connected to the same place
+	(such as stdout and stderr both going to the same terminal), meaning
+	the relative order of writes to them matters.
+	"""
+	if a is b:
+		return True
+	try:
+		sa = os.fstat(a.fileno())
+		sb = os.fstat(b.fileno())
+	except (AttributeError, OSError, ValueError):
+		return False
+	return (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino)
+# }}}
+class OutputFrame(object):# {{{
+	"""
+	Collects the output of a render pass across one or more streams, so it
+	can be handed off with as few write() and flush() calls as possible.
+
+	Writes are made through FrameWriter objects. While a frame is open
+	(begin() has been called more often than end()), flushes are deferred
+	until the outermost end(). Outside of a frame, a flush sends everything
+	collected so far.
+
+	If interleave is True, the streams are assumed to share a destination,
+	so output is sent in the order it was written, with one write and
+	flush per run of same-stream data. Otherwise each stream gets a single
+	write and flush per frame.
+	"""
+	def __init__(self, interleave=True):
+		self.interleave = interleave
+		self.depth = 0
+		# List of [outfile, bytearray] pairs, in the order they were written.
+		self.segments = []
+		# How many write()/flush() calls we were asked to make...
+		self.calls = 0
+		# ...versus how many we actually made.
+		self.syscalls = 0
+		# Frames actually sent, flush() calls made, and bytes written per
+		# outfile.
+		self.frames = 0
+		self.flushes = 0
+		self.bytes_written = {}
+	@property
+	def saved(self):
+		"""
+		The number of write() and flush() calls avoided by batching.
+		"""
+		return self.calls - self.syscalls
+	def begin(self):
+		self.depth += 1
+	def end(self):
+		self.depth -= 1
+		if self.depth <= 0:
+			self.depth = 0
+			self.commit()
+	def write(self, outfile, data):
+		self.calls += 1
+		if len(self.segments) > 0 and self.segments[-1][0] is outfile:
+			self.segments[-1][1] += data
+		else:
+			self.segments.append([outfile, bytearray(data)])
+	def flush(self, outfile):
+		self.calls += 1
+		if self.depth == 0:
+			self.commit()
+	def commit(self):
+		segments, self.segments = self.segments, []
+		if len(segments) < 1:
+			return
+		if not self.interleave and len(segments) > 1:
+			merged = []
+			for outfile, data in segments:
+				for seg in merged:
+					if seg[0] is outfile:
+						seg[1] += data
+						break
+				else:
+					merged.append([outfile, data])
+			segments = merged
+		self.frames += 1
+		for outfile, data in segments:
+			self.bytes_written[outfile] = self.bytes_written.get(outfile, 0) + len(data)
+			outfile.write(bytes(data))
+			# Funny little workaround
+			while True:
+				try:
+					outfile.flush()
+					break
+				except IOError:
+					pass
+			self.flushes += 1
+			self.syscalls += 2
+	def reset_counters(self):
+		self.calls = 0
+		self.syscalls = 0
+		self.frames = 0
+		self.flushes = 0
+		self.bytes_written = {}
+# }}}
+class FrameWriter(object):# {{{
+	"""
+	File-like front end that feeds writes to one stream into an OutputFrame.
+	"""
+	def __init__(self, frame, outfile):
+		self.frame = frame
+		self.outfile = outfile
+	def write(self, data):
+		self.frame.write(self.outfile, data)
+	def flush(self):
+		self.frame.flush(self.outfile)
+# }}}
+class ByteSink(object):# {{{
+	"""
+	In-memory output target, for running headless (see Term.setOutput()).
+	Counts writes, flushes and bytes, and, if keep is True, hangs on to
+	what was written.
+	"""
+	def __init__(self, keep=True):
+		self.keep = keep
+		self.data = bytearray()
+		self.writes = 0
+		self.flushes = 0
+		self.nbytes = 0
+	def write(self, data):
+		self.writes += 1
+		self.nbytes += len(data)
+		if self.keep:
+			self.data += data
+		return len(data)
+	def flush(self):
+		self.flushes += 1
+	def isatty(self):
+		return False
+	def getvalue(self):
+		return bytes(self.data)
+	def clear(self):
+		self.data = bytearray()
+		self.writes = 0
+		self.flushes = 0
+		self.nbytes = 0
+# }}}
+# Things VirtualTerminal.feed() acts on: CSI sequences, other escapes, and
+# control characters.
+_vt_token_pat = re.compile("\x1b\\[([0-?]*)[ -/]*([@-~])|\x1b[^\\[]|[\x00-\x1a\x1c-\x1f\x7f]")
+_vt_partial_pat = re.compile("\x1b(?:\\[[0-?]*[ -/]*)?$")
+class VirtualTerminal(ByteSink):# {{{
+	"""
+	A minimal VT100 screen emulator to use as an output target. It
+	understands what JaysTerm itself writes: printable text (including
+	double-width characters), CR, LF, backspace, tab, cursor movement
+	(CSI A B C D G H f), erasing (CSI J K), line wrap on/off (CSI ? 7 h/l)
+	and cursor visibility (CSI ? 25 h/l). Colors and anything else are
+	ignored.
+
+	LF also returns the carriage, as the tty driver normally arranges.
+
+	After writing to it, the screen can be inspected with line(), text()
+	and cursor.
+	"""
+	def __init__(self, width=80, height=24, keep=False):
+		super().__init__(keep=keep)
+		self.width = width
+		self.height = height
+		self.rows = [ [' '] * width for x in range(height) ]
+		self.row = 0
+		self.col = 0
+		# Set when a character lands in the last column; the wrap happens
+		# when the next one comes along.
+		self.wrap_pending = False
+		self.autowrap = True
+		self.cursor_visible = True
+		self.decoder = InputDecoder()
+		self.pending = ''
+	@property
+	def size(self):
+		return (self.width, self.height)
+	@property
+	def cursor(self):
+		"""
+		Cursor position as (col, row), counting from 0.
+		"""
+		return (self.col, self.row)
+	def write(self, data):
+		ret = super().write(data)
+		self.feed(data)
+		return ret
+	def line(self, row):
+		"""
+		Returns what's displayed on a row, minus trailing blanks.
+		"""
+		return ''.join(self.rows[row]).rstrip()
+	def text(self):
+		"""
+		Returns the whole screen as a string, minus trailing blank lines.
+		"""
+		return "\n".join([ self.line(x) for x in range(self.height) ]).rstrip("\n")
+	def feed(self, data):
+		text = self.pending + self.decoder.decode(data)
+		self.pending = ''
+		pos = 0
+		end = len(text)
+		for mat in _vt_token_pat.finditer(text):
+			if mat.start() > pos:
+				self.put(text[pos:mat.start()])
+			pos = mat.end()
+			if mat.group(2) is not None:
+				self.csi(mat.group(1), mat.group(2))
+			else:
+				self.control(mat.group(0))
+		if pos < end:
+			rest = text[pos:]
+			partial = _vt_partial_pat.search(rest)
+			if partial is not None:
+				# Incomplete escape sequence, wait for the rest of it.
+				self.pending = rest[partial.start():]
+				rest = rest[:partial.start()]
+			self.put(rest)
+	def put(self, text):
+		for char in text:
+			width = wcwidth.wcwidth(char)
+			if width < 1:
+				continue
+			if self.wrap_pending:
+				self.wrap_pending = False
+				self.col = 0
+				self.linefeed()
+			if self.col + width > self.width:
+				if self.autowrap:
+					self.col = 0
+					self.linefeed()
+				else:
+					self.col = self.width - width
+			row = self.rows[self.row]
+			self.clear_cell(self.col)
+			if width == 2:
+				self.clear_cell(self.col + 1)
+			row[self.col] = char
+			if width == 2:
+				row[self.col + 1] = ''
+			self.col += width
+			if self.col >= self.width:
+				self.col = self.width - 1
+				self.wrap_pending = self.autowrap
+	def clear_cell(self, col):
+		"""
+		Blanks out the other half of any double-width character at col, on
+		the current row, since it's about to be overwritten.
+		"""
+		row = self.rows[self.row]
+		if row[col] == '' and col > 0:
+			row[col - 1] = ' '
+		elif col + 1 < self.width and row[col + 1] == '':
+			row[col + 1] = ' '
+	def linefeed(self):
+		if self.row < self.height - 1:
+			self.row += 1
+		else:
+			self.rows.pop(0)
+			self.rows.append([' '] * self.width)
+	def control(self, seq):
+		if seq == '\n':
+			self.col = 0
+			self.linefeed()
+		elif seq == '\r':
+			self.col = 0
+		elif seq == '\x08':
+			if self.col > 0:
+				self.col -= 1
+		elif seq == '\t':
+			self.col = min(self.width - 1, (self.col // 8 + 1) * 8)
+		else:
+			return
+		self.wrap_pending = False
+	def csi(self, params, final):
+		private = params.startswith('?')
+		args = [ int(x) if x.isdigit() else 0 for x in params.lstrip('?').split(';') ]
+		count = max(1, args[0])
+		if final in 'hl':
+			if private and 7 in args:
+				self.autowrap = final == 'h'
+			if private and 25 in args:
+				self.cursor_visible = final == 'h'
+			return
+		if final == 'A':
+			self.row = max(0, self.row - count)
+		elif final == 'B':
+			self.row = min(self.height - 1, self.row + count)
+		elif final == 'C':
+			self.col = min(self.width - 1, self.col + count)
+		elif final == 'D':
+			self.col = max(0, self.col - count)
+		elif final == 'G':
+			self.col = min(self.width, count) - 1
+		elif final in 'Hf':
+			self.row = min(self.height, count) - 1
+			self.col = min(self.width, max(1, args[1]) if len(args) > 1 else 1) - 1
+		elif final == 'J':
+			if args[0] == 0:
+				self.erase(self.row, self.col, self.width)
+				for x in range(self.row + 1, self.height):
+					self.rows[x] = [' '] * self.width
+			elif args[0] == 1:
+				for x in range(0, self.row):
+					self.rows[x] = [' '] * self.width
+				self.erase(self.row, 0, self.col + 1)
+			else:
+				self.rows = [ [' '] * self.width for x in range(self.height) ]
+		elif final == 'K':
+			if args[0] == 0:
+				self.erase(self.row, self.col, self.width)
+			elif args[0] == 1:
+				self.erase(self.row, 0, self.col + 1)
+			else:
+				self.erase(self.row, 0, self.width)
+		else:
+			# Colors and whatnot don't move the cursor.
+			return
+		self.wrap_pending = False
+	def erase(self, row, start, end):
+		cells = self.rows[row]
+		# Don't leave half of a double-width character behind.
+		if start > 0 and cells[start] == '':
+			start -= 1
+		if end < self.width and cells[end] == '':
+			end += 1
+		cells[start:end] = [' '] * (end - start)
+# }}}
+def text_cells(text):# {{{
+	"""
+	Breaks a string up into terminal cells, returning a list of
+	(sgr_state, character) tuples, one per column. sgr_state is the
+	string of color escape sequences in effect for that cell. The second
+	column of a double-width character gets an empty character string.
+
+	Returns None if the text contains anything (cursor movement,
+	control characters, etc) that can't be expressed as cells.
+	"""
+	cells = []
+	state = ''
+	pos = 0
+	end = len(text)
+	while pos <= end:
+		mat = _esc_pat.search(text, pos)
+		chunk_end = end if mat is None else mat.start()
+		for ch in text[pos:chunk_end]:
+			w = wcwidth.wcwidth(ch)
+			if w == 1:
+				cells.append((state, ch))
+			elif w == 2:
+				cells.append((state, ch))
+				cells.append((state, ''))
+			elif w == 0:
+				# Combining characters ride along with the previous cell.
+				if len(cells) > 0:
+					if cells[-1][1] == '' and len(cells) > 1:
+						cells[-2] = (cells[-2][0], cells[-2][1] + ch)
+					else:
+						cells[-1] = (cells[-1][0], cells[-1][1] + ch)
+			else:
+				return None
+		if mat is None:
+			break
+		seq = mat.group(0)
+		if _sgr_pat.match(seq) is None:
+			return None
+		if seq in ('\x1b[m', '\x1b[0m'):
+			state = ''
+		else:
+			state += seq
+		pos = mat.end()
+	return cells
+# }}}
+class ScreenLine(object):# {{{
+	"""
+	Screen model for a single DotPrinterSlots row.
+
+	Keeps hold of the cells (as returned by text_cells()) that were last
+	drawn on the row, so that subsequent repaints only need to emit the
+	cursor movement and characters for cells that actually changed.
+	"""
+	# Runs of changed cells separated by this many unchanged cells or fewer
+	# get merged, as rewriting the cells is cheaper than moving the cursor.
+	merge_gap = 3
+	def __init__(self):
+		self.cells = None
+	def invalidate(self):
+		"""
+		Forgets what's on the row, forcing the next render() to redraw
+		it from scratch.
+		"""
+		self.cells = None
+	@staticmethod
+	def clip(cells, width):
+		if len(cells) <= width:
+			return cells
+		clipped = cells[:width]
+		if width > 0 and cells[width][1] == '':
+			# Don't leave the first half of a double-width character hanging.
+			clipped[-1] = ('', ' ')
+		return clipped
+	@staticmethod
+	def emit(cells):
+		"""
+		Returns the bytes needed to draw cells, switching colors as needed.
+		"""
+		out = []
+		state = ''
+		for st, ch in cells:
+			if st != state:
+				if state != '':
+					out.append('\x1b[0m')
+				out.append(st)
+				state = st
+			out.append(ch)
+		if state != '':
+			out.append('\x1b[0m')
+		return ''.join(out).encode()
+	def render_raw(self, text):
+		"""
+		Returns the bytes needed to draw arbitrary text on the row. Since
+		there's no telling what's on screen afterwards, the next render()
+		will be a full redraw.
+		"""
+		self.cells = None
+		return ansi_bytes['clear_line_nowrap'] + text.encode() + ansi_bytes['enable_line_wrap'] + ansi_bytes['color_normal']
+	def render(self, cells, width):
+		"""
+		Returns the bytes needed to bring the row up to date with cells,
+		assuming the cursor is already on the row. Only changed cells are
+		drawn, unless invalidate() has been called since the last render.
+		"""
+		if cells is None:
+			return self.render_raw('')
+		cells = self.clip(cells, width)
+		old = self.cells
+		self.cells = cells
+		if old is None:
+			return ansi_bytes['clear_line_nowrap'] + self.emit(cells) + ansi_bytes['enable_line_wrap']
+		runs = []
+		n_old = len(old)
+		n_new = len(cells)
+		i = 0
+		while i < n_new:
+			if i < n_old and old[i] == cells[i]:
+				i += 1
+				continue
+			start = i
+			# Back up to the start of a double-width character.
+			while start > 0 and cells[start][1] == '':
+				start -= 1
+			i += 1
+			while i < n_new and (i >= n_old or old[i] != cells[i]):
+				i += 1
+			if len(runs) > 0 and start - runs[-1][1] <= self.merge_gap:
+				runs[-1][1] = i
+			else:
+				runs.append([start, i])
+		out = []
+		wrap = len(runs) > 0 and runs[-1][1] >= width
+		if wrap:
+			out.append(ansi_bytes['disable_line_wrap'])
+		for start, stop in runs:
+			out.append(ansi_param('cursor_horizontal_absolute', start + 1))
+			out.append(self.emit(cells[start:stop]))
+		if wrap:
+			out.append(ansi_bytes['enable_line_wrap'])
+		if n_new < n_old:
+			out.append(ansi_param('cursor_horizontal_absolute', n_new + 1))
+			out.append(ansi_bytes['erase_line_from_cursor'])
+		return b''.join(out)
+# }}}
+class RenderStats(object):# {{{
+	"""
+	Counters kept by DotPrinterSlots while stats are turned on. See
+	DotPrinterSlots.enableStats().
+
+	Counts made from worker threads without the lock (update() in renderer
+	mode) aren't atomic, so treat them as approximate.
+	"""
+	def __init__(self):
+		self.started = monotonic()
+		# update() calls received, across all slots.
+		self.updates = 0
+		# Lock acquisitions, and seconds spent waiting for them.
+		self.lock_acquires = 0
+		self.lock_wait = 0.0
+		# Slot type name -> [refresh() calls, seconds spent in them]
+		self.refreshes = {}
+	def add_refresh(self, dp, seconds):
+		name = type(dp).__name__
+		if name not in self.refreshes:
+			self.refreshes[name] = [0, 0.0]
+		entry = self.refreshes[name]
+		entry[0] += 1
+		entry[1] += seconds
+# }}}
+def format_stats(stats):# {{{
+	"""
+	Squishes the dict returned by DotPrinterSlots.stats() onto one line.
+	"""
+	parts = [
+		"{:.1f}s".format(stats['elapsed']),
+		"updates={}".format(stats['updates']),
+		"frames={}".format(stats['frames']),
+		"flushes={}".format(stats['flushes']),
+	]
+	for name, count in stats['bytes'].items():
+		parts.append("{}={}B".format(name, count))
+	for name, entry in stats['refresh'].items():
+		parts.append("{}={}x/{:.3f}s".format(name, entry['count'], entry['seconds']))
+	parts.append("lock_wait={:.3f}s".format(stats['lock_wait']))
+	return "stats: " + " ".join(parts)
+# }}}
+class SlotsBatch(object):# {{{
+	"""
+	Handed out by DotPrinterSlots.batch(). Its methods assume the lock is
+	held, which it is for as long as the batch lasts.
+	"""
+	def line(self, *values, **kwargs):
+		DotPrinterSlots._line(*values, **kwargs)
+# }}}
 class DotPrinterSlots(object):
 	#dotfile=DumbWriter(sys.stderr)
 	#printfile=sys.stdout
@@ -405,18 +1300,106 @@ class DotPrinterSlots(object):
 	init_complete = False
 	preferred_slot = None
 	write_buf = ''
+	# Render scheduling. When fps is None (the default), every update() is
+	# drawn immediately. Otherwise, update() merely marks its slot dirty,
+	# and dirty slots are repainted at most fps times per second. Call
+	# setFps() to turn this on.
+	fps = None
+	frame_interval = 0.0
+	last_frame = 0.0
+	dirty = []
+	# ScreenLine objects for each slot, keyed by slot.
+	screens = {}
+	# All output goes through this, so that it can be batched up. printfile
+	# and dotfile are FrameWriters feeding into it.
+	frame = OutputFrame()
+	# Set by line() when it's wiped out the stack in order to print above
+	# it. Drawing is put off until the stack gets redrawn by refresh().
+	stack_erased = False
+	# Renderer thread, see startRenderer(). While it's running, update()
+	# calls just post() their slot here instead of drawing anything.
+	renderer = None
+	renderer_stop = None
+	posted = set()
+	# Callables the renderer thread runs at the start of every frame, for
+	# things (like ProgressAggregator) that need to go looking for updates.
+	frame_hooks = []
+	# A RenderStats while stats are on, otherwise None. See enableStats().
+	render_stats = None
+	stats_dumper = None
+	stats_dumper_stop = None
 	@classmethod
 	def init(cls):
 		if not cls.init_complete:
 			Term.init()
 			Term.disableCursor()
-			cls.printfile = Term.stdout
-			cls.dotfile = DumbWriter(Term.stderr)
+			cls.frame.interleave = same_destination(Term.stdout, Term.stderr)
+			cls.printfile = FrameWriter(cls.frame, Term.stdout)
+			cls.dotfile = FrameWriter(cls.frame, DumbWriter(Term.stderr))
 			cls.init_complete = True
 	@classmethod
+	def retarget(cls):
+		"""
+		Points printfile and dotfile at Term.stdout and Term.stderr again,
+		after Term.setOutput() has changed them. Everything gets redrawn on
+		the new target.
+		"""
+		if not cls.init_complete:
+			return
+		cls.frame.commit()
+		cls.frame.interleave = same_destination(Term.stdout, Term.stderr)
+		cls.printfile.outfile = Term.stdout
+		cls.dotfile.outfile = DumbWriter(Term.stderr)
+		cls.refresh()
+	@classmethod
+	def beginFrame(cls):
+		"""
+		Starts batching output. Nothing is sent to the terminal until the
+		matching endFrame() call.
+		"""
+		cls.frame.begin()
+	@classmethod
+	def endFrame(cls):
+		"""
+		Ends a batch started by beginFrame(). When the outermost batch ends,
+		the stack is redrawn if need be, and all output is sent.
+		"""
+		if cls.frame.depth == 1 and cls.stack_erased:
+			cls.refresh()
+		cls.frame.end()
+	@classmethod
+	@contextlib.contextmanager
+	def batch(cls):
+		"""
+		Context manager which holds the lock and batches up all output made
+		within it into a single frame. Useful for printing many lines at
+		once:
+
+			with DotPrinterSlots.batch() as b:
+				for x in things:
+					b.line(x)
+
+		Use the line() of the object it hands back, rather than
+		DotPrinterSlots.line(), as the latter takes the lock itself (and
+		would hang, if the lock isn't reentrant).
+		"""
+		cls.lock()
+		cls.beginFrame()
+		try:
+			yield SlotsBatch()
+		finally:
+			cls.endFrame()
+			cls.release()
+	@classmethod
 	def lock(cls):
 		if cls.lockobj is not None:
-			cls.lockobj.acquire()
+			if cls.render_stats is None:
+				cls.lockobj.acquire()
+			else:
+				start = monotonic()
+				cls.lockobj.acquire()
+				cls.render_stats.lock_wait += monotonic() - start
+				cls.render_stats.lock_acquires += 1
 	@classmethod
 	def release(cls):
 		if cls.preferred_slot is not None:
@@ -442,19 +1425,30 @@ class DotPrinterSlots(object):
 		cls.refresh()
 	@classmethod
 	def deregister(cls, dp, msg):
-		import jlib
 		if cls.preferred_slot == dp:
 			cls.preferred_slot = None
 		if dp not in cls.slots:
 			return
+		cls.beginFrame()
+		try:
+			cls._deregister(dp, msg)
+		finally:
+			cls.endFrame()
+	@classmethod
+	def _deregister(cls, dp, msg):
 		if msg is not None:
-			cls.line(msg)
+			cls._line(msg)
 		if len(cls.slots) > 0:
 			for i in range(len(cls.slots)):
 				cls.setActive(cls.slots[i])
-				cls.dotfile.write((jlib.encapsulate_ansi('erase_line') + jlib.encapsulate_ansi('cursor_horizontal_absolute', ['1'])).encode())
+				cls.dotfile.write(ansi_bytes['clear_line'])
 			cls.setActive(cls.slots[0])
 		cls.slots.remove(dp)
+		if dp in cls.screens:
+			del cls.screens[dp]
+		if dp in cls.dirty:
+			cls.dirty.remove(dp)
+		cls.posted.discard(dp)
 		#else:
 			#cls.dotfile.write(jlib.encapsulate_ansi('erase_line') + jlib.encapsulate_ansi('cursor_horizontal_absolute', ['1']))
 			#cls.dotfile.write("\n")
@@ -464,23 +1458,266 @@ class DotPrinterSlots(object):
 		cls.refresh()
 	@classmethod
 	def refresh(cls):
-		refresh_flush = True
-		if cls.preferred_slot is not None:
-			refresh_flush = False
-		first = True
+		# Everything gets redrawn, so nothing is dirty anymore, and whatever
+		# is on screen can't be trusted for diffing.
+		cls.dirty = []
+		cls.stack_erased = False
+		for x in cls.screens.values():
+			x.invalidate()
+		cls.beginFrame()
+		try:
+			refresh_flush = True
+			if cls.preferred_slot is not None:
+				refresh_flush = False
+			first = True
+			for x in cls.slots:
+				if first:
+					first = False
+				else:
+					cls.dotfile.write(b"\n")
+				cls.refreshSlot(x, activate=False, flush=refresh_flush)
+			if len(cls.slots) > 0:
+				cls.activeidx = len(cls.slots) - 1
+			if cls.preferred_slot is not None:
+				cls.setActive(cls.preferred_slot)
+		finally:
+			cls.endFrame()
+	@classmethod
+	def refreshSlot(cls, dp, activate=True, flush=True):
+		"""
+		Calls dp.refresh(), timing it if stats are on.
+		"""
+		if cls.render_stats is None:
+			dp.refresh(activate=activate, flush=flush)
+			return
+		start = monotonic()
+		dp.refresh(activate=activate, flush=flush)
+		cls.render_stats.add_refresh(dp, monotonic() - start)
+	@classmethod
+	def enableStats(cls, dump_interval=None, dump=None):
+		"""
+		Starts keeping count of what rendering is costing; see stats(). Any
+		counts from before are thrown away.
+
+		If dump_interval is given, a background thread calls dump with the
+		stats() dict every dump_interval seconds. dump defaults to printing
+		them with line() on stderr, so they don't end up in redirected
+		stdout. As with startRenderer(), a lock is installed if there isn't
+		one already, since that thread and everybody else will be taking
+		turns with the terminal.
+		"""
+		import threading
+		cls.disableStats()
+		cls.frame.reset_counters()
+		cls.render_stats = RenderStats()
+		if dump_interval is not None:
+			if cls.lockobj is None:
+				cls.lockobj = threading.RLock()
+			if dump is None:
+				dump = lambda x: cls.line(format_stats(x), printfile=False)
+			cls.stats_dumper_stop = threading.Event()
+			def dumpLoop(stop):
+				while not stop.wait(dump_interval):
+					dump(cls.stats())
+			cls.stats_dumper = threading.Thread(target=dumpLoop, args=(cls.stats_dumper_stop,), name="DotPrinterSlots stats", daemon=True)
+			cls.stats_dumper.start()
+	@classmethod
+	def disableStats(cls):
+		"""
+		Stops keeping count, and stops the periodic dump, if any.
+		"""
+		import threading
+		if cls.stats_dumper is not None:
+			cls.stats_dumper_stop.set()
+			if cls.stats_dumper is not threading.current_thread():
+				cls.stats_dumper.join()
+			cls.stats_dumper = None
+			cls.stats_dumper_stop = None
+		cls.render_stats = None
+	@classmethod
+	def stats(cls):
+		"""
+		Returns a dict of counters collected since enableStats(), or None if
+		stats aren't on:
+
+		* elapsed — seconds since enableStats()
+		* updates — update() calls received
+		* frames — batches of output actually sent to the terminal
+		* writes, flushes — write() and flush() calls made on the streams
+		* calls_saved — write()/flush() calls avoided by batching
+		* bytes — bytes written, per stream ('stdout' and 'stderr')
+		* refresh — per slot type, {'count': refresh() calls, 'seconds': time spent in them}
+		* lock_acquires, lock_wait — lock acquisitions, and seconds spent waiting
+		"""
+		rs = cls.render_stats
+		if rs is None:
+			return None
+		names = {}
+		if cls.init_complete:
+			names[cls.printfile.outfile] = 'stdout'
+			names[cls.dotfile.outfile] = 'stderr'
+		byte_counts = {}
+		for outfile, count in list(cls.frame.bytes_written.items()):
+			name = names.get(outfile, repr(outfile))
+			byte_counts[name] = byte_counts.get(name, 0) + count
+		return {
+			'elapsed': monotonic() - rs.started,
+			'updates': rs.updates,
+			'frames': cls.frame.frames,
+			'writes': cls.frame.syscalls - cls.frame.flushes,
+			'flushes': cls.frame.flushes,
+			'calls_saved': cls.frame.saved,
+			'bytes': byte_counts,
+			'refresh': { name: {'count': entry[0], 'seconds': entry[1]} for name, entry in list(rs.refreshes.items()) },
+			'lock_acquires': rs.lock_acquires,
+			'lock_wait': rs.lock_wait,
+		}
+	@classmethod
+	def screen(cls, dp):
+		"""
+		Returns the ScreenLine tracking what's drawn on dp's row.
+		"""
+		if dp not in cls.screens:
+			cls.screens[dp] = ScreenLine()
+		return cls.screens[dp]
+	@classmethod
+	def setFps(cls, fps):
+		"""
+		Turns on coalesced rendering, limiting repaints of the stack to at
+		most `fps` frames per second. Pass None to go back to drawing every
+		update() as it happens.
+
+		Note that with coalescing on, the last few updates before things go
+		quiet may not be drawn until the next update(), renderFrame() or
+		close() comes along.
+
+		Doesn't affect a running renderer thread (see startRenderer()).
+		"""
+		if fps is None or fps <= 0:
+			cls.fps = None
+			cls.frame_interval = 0.0
+			if len(cls.dirty) > 0:
+				cls.lock()
+				cls.renderFrame()
+				cls.release()
+		else:
+			cls.fps = fps
+			cls.frame_interval = 1.0 / fps
+	@classmethod
+	def markDirty(cls, dp):
+		"""
+		Flags a slot as needing a repaint, and renders a frame if enough time
+		has passed since the last one. Returns True if a frame was rendered.
+		Assumes the caller is holding the lock.
+		"""
+		if dp not in cls.dirty:
+			cls.dirty.append(dp)
+		if monotonic() - cls.last_frame >= cls.frame_interval:
+			cls.renderFrame()
+			return True
+		return False
+	@classmethod
+	def renderFrame(cls):
+		"""
+		Repaints every dirty slot right now, regardless of the frame rate.
+		Assumes the caller is holding the lock.
+		"""
+		cls.last_frame = monotonic()
+		if len(cls.dirty) < 1:
+			return
+		dirty, cls.dirty = cls.dirty, []
 		for x in cls.slots:
-			if first:
-				first = False
-			else:
-				cls.dotfile.write("\n".encode())
-			x.refresh(activate=False, flush=refresh_flush)
-		if len(cls.slots) > 0:
-			cls.activeidx = len(cls.slots) - 1
-		if cls.preferred_slot is not None:
-			cls.setActive(cls.preferred_slot)
+			if x in dirty:
+				cls.refreshSlot(x, activate=True, flush=False)
+		cls.dotfile.flush()
+	@classmethod
+	def startRenderer(cls, fps=30):
+		"""
+		Hands the terminal over to a background thread, which repaints
+		updated slots at most `fps` times per second. From then on, update()
+		calls from any thread only record the new value and post() the slot,
+		so workers never wait on the lock or on terminal output.
+
+		Installs a lock if there isn't one already, since the renderer and
+		everybody else will be taking turns with the terminal.
+
+		The renderer sticks to this frame rate until stopRenderer(), even if
+		setFps() is called in the meantime.
+		"""
+		import threading
+		if cls.renderer is not None:
+			return
+		if fps is None or fps <= 0:
+			raise ValueError("startRenderer() needs a positive fps")
+		if cls.lockobj is None:
+			cls.lockobj = threading.RLock()
+		cls.setFps(fps)
+		cls.renderer_stop = threading.Event()
+		cls.renderer = threading.Thread(target=cls.renderLoop, args=(cls.renderer_stop, 1.0 / fps), name="DotPrinterSlots renderer", daemon=True)
+		cls.renderer.start()
+		atexit.register(cls.stopRenderer)
+	@classmethod
+	def stopRenderer(cls):
+		"""
+		Stops the renderer thread started by startRenderer(), after drawing
+		any updates it hadn't gotten to yet. update() goes back to drawing
+		for itself (still coalesced to the same frame rate).
+		"""
+		if cls.renderer is None:
+			return
+		cls.renderer_stop.set()
+		cls.renderer.join()
+		cls.renderer = None
+		cls.renderer_stop = None
+	@classmethod
+	def renderLoop(cls, stop, interval):
+		while not stop.wait(interval):
+			cls.runFrameHooks()
+			cls.renderPosted()
+		cls.runFrameHooks()
+		cls.renderPosted()
+	@classmethod
+	def runFrameHooks(cls):
+		for hook in list(cls.frame_hooks):
+			hook()
+	@classmethod
+	def post(cls, dp):
+		"""
+		Lets the renderer thread know dp has changed. Doesn't take the lock,
+		or do any I/O.
+		"""
+		cls.posted.add(dp)
+	@classmethod
+	def collectPosted(cls):
+		"""
+		Moves posted slots onto the dirty list. Assumes the caller is holding
+		the lock.
+		"""
+		# pop() rather than swapping the set out, so that a post() racing
+		# with us can't get lost.
+		while len(cls.posted) > 0:
+			dp = cls.posted.pop()
+			if dp not in cls.dirty:
+				cls.dirty.append(dp)
+	@classmethod
+	def renderPosted(cls):
+		"""
+		Renders a frame if anything has been posted since the last one.
+		"""
+		if len(cls.posted) < 1:
+			return
+		cls.lock()
+		try:
+			cls.collectPosted()
+			cls.renderFrame()
+		finally:
+			cls.release()
 	@classmethod
 	def setActive(cls, dp):
-		import jlib
+		if cls.stack_erased:
+			# The cursor needs to stay put at the top of the (now blank)
+			# stack until it gets redrawn.
+			return
 		if cls.slots[cls.activeidx] == dp:
 			# Quick shortcircuit if we're already the active slot.
 			return
@@ -490,16 +1727,15 @@ class DotPrinterSlots(object):
 		cls.activeidx = cls.slots.index(dp)
 		delta = cls.activeidx - curridx
 		if delta < 0:
-			cls.dotfile.write(jlib.encapsulate_ansi('cursor_up', ["{}".format(abs(delta))]).encode())
+			cls.dotfile.write(ansi_param('cursor_up', -delta))
 		elif delta > 0:
-			cls.dotfile.write(jlib.encapsulate_ansi('cursor_down', ["{}".format(delta)]).encode())
+			cls.dotfile.write(ansi_param('cursor_down', delta))
 		if hasattr(dp, 'activation_cb'):
 			dp.activation_cb()
 	@classmethod
 	def clear(cls):
-		import jlib
 		cls.setActive(cls.slots[0])
-		cls.dotfile.write((jlib.encapsulate_ansi('erase_screen') + jlib.encapsulate_ansi('cursor_position', ['1', '1'])).encode())
+		cls.dotfile.write(ansi_bytes['erase_screen'] + ansi_param('cursor_position', 1, 1))
 		cls.refresh()
 	@classmethod
 	def line(cls, *values, sep=' ', end='', file=None, printfile=True, **kwargs):
@@ -522,8 +1758,19 @@ class DotPrinterSlots(object):
 		orig_print = print
 		print = JaysTerm.DotPrinterSlots.line
 
+		Takes the lock, so don't call it while holding the lock yourself;
+		use _line() for that.
+		"""
+		cls.lock()
+		try:
+			cls._line(*values, sep=sep, end=end, file=file, printfile=printfile)
+		finally:
+			cls.release()
+	@classmethod
+	def _line(cls, *values, sep=' ', end='', file=None, printfile=True, **kwargs):
+		"""
+		Does the work of line(). Assumes the caller is holding the lock.
 		"""
-		import jlib
 		values = [ x if type(x) in StringTypes else str(x) for x in values ]
 		msg = sep.join(values)
 		# Make sure "file" goes to where it's supposed to go, if it's not
@@ -538,29 +1785,24 @@ class DotPrinterSlots(object):
 			print_fh = cls.printfile
 		else:
 			print_fh = cls.dotfile
-		# go to the top of the stack
-		if len(cls.slots) > 0:
-			cls.setActive(cls.slots[0])
-		# on "stderr", erase line, move cursor to line start, flush
-		cls.dotfile.write((jlib.encapsulate_ansi('erase_line') + jlib.encapsulate_ansi('cursor_horizontal_absolute', ['1'])).encode())
-		cls.dotfile.flush()
-		# on "stdout", write our line (but don't move to the next just yet), flush
-		print_fh.write(msg.encode())
-		# Funny little workaround
-		while True:
-			try:
-				print_fh.flush()
-				break
-			except IOError:
-				pass
-		# on "stderr", erase the rest of the line, flush
-		cls.dotfile.write(jlib.encapsulate_ansi('erase_line_from_cursor').encode())
-		cls.dotfile.flush()
-		# on "stdout", advance to the next line, flush
-		print_fh.write("\n".encode())
-		print_fh.flush()
-		# redraw the stack
-		cls.refresh()
+		cls.beginFrame()
+		try:
+			if not cls.stack_erased:
+				# go to the top of the stack
+				if len(cls.slots) > 0:
+					cls.setActive(cls.slots[0])
+				# on "stderr", erase everything from the top of the stack
+				# down, and move cursor to line start. Nothing gets drawn
+				# in the stack until it's redrawn, so any further lines in
+				# this frame go straight out on "stdout".
+				cls.dotfile.write(ansi_bytes['clear_line'] + ansi_bytes['erase_below'])
+				cls.stack_erased = True
+			# on "stdout", write our line and advance to the next
+			print_fh.write((msg + "\n").encode())
+			print_fh.flush()
+		finally:
+			# redraw the stack, unless we're part of a bigger frame
+			cls.endFrame()
 	@classmethod
 	def write(cls, text):
 		cls.write_buf += text
@@ -628,42 +1870,42 @@ class UpdatingLine:
 	def getBuf(self):
 		return self.buf
 	def refresh(self, activate=True, flush=True):
-		import jlib
-		if self.closed:
+		if self.closed or DotPrinterSlots.stack_erased:
 			return
 		if activate:
 			DotPrinterSlots.setActive(self)
-		colSize = Term.size[0]
-		#newTxt = formatLine(self.buf, colSize, self.justify, self.moreString)
-		self.dotfile.write((jlib.encapsulate_ansi('erase_line') + jlib.encapsulate_ansi('cursor_horizontal_absolute', ['1']) + jlib.encapsulate_ansi('disable_line_wrap')).encode())
-		#self.dotfile.write(newTxt)
-		self.dotfile.write(self.buf.encode())
-		self.dotfile.write((jlib.encapsulate_ansi('enable_line_wrap') + jlib.encapsulate_ansi('color', [jlib.ansi_colors['normal']])).encode())
+		screen = DotPrinterSlots.screen(self)
+		cells = text_cells(self.buf)
+		if cells is None:
+			self.dotfile.write(screen.render_raw(self.buf))
+		else:
+			self.dotfile.write(screen.render(cells, Term.size[0]))
 		if flush:
 			self.dotfile.flush()
 	def update(self, txt=None, flush=True):
-		import jlib
 		if self.closed:
 			return
+		if DotPrinterSlots.render_stats is not None:
+			DotPrinterSlots.render_stats.updates += 1
+		if DotPrinterSlots.renderer is not None:
+			if txt is not None:
+				self.buf = txt
+			DotPrinterSlots.post(self)
+			return
 		DotPrinterSlots.lock()
-		DotPrinterSlots.setActive(self)
-		colSize = Term.size[0]
 		if txt is None:
 			txt = self.buf
-		lastLineLen = 0
-		self.dotfile.write((jlib.encapsulate_ansi('erase_line') + jlib.encapsulate_ansi('cursor_horizontal_absolute', ['1']) + jlib.encapsulate_ansi('disable_line_wrap')).encode())
-		self.dotfile.write(txt.encode())
-		self.dotfile.write((jlib.encapsulate_ansi('enable_line_wrap') + jlib.encapsulate_ansi('color', [jlib.ansi_colors['normal']])).encode())
-		self.dotfile.write(jlib.encapsulate_ansi('cursor_horizontal_absolute', ["1"]).encode())
-		if flush:
-			self.dotfile.flush()
 		self.buf = txt
+		if DotPrinterSlots.fps is not None:
+			DotPrinterSlots.markDirty(self)
+		else:
+			DotPrinterSlots.refreshSlot(self, flush=flush)
 		DotPrinterSlots.release()
 	def line(self, *values, sep=' ', end='', file=None, printfile=True, **kwargs):
 		if self.closed:
 			return
 		DotPrinterSlots.lock()
-		DotPrinterSlots.line(*values, sep=sep, end=end, file=file, printfile=printfile)
+		DotPrinterSlots._line(*values, sep=sep, end=end, file=file, printfile=printfile)
 		DotPrinterSlots.release()
 	def write(self, text):
 		self.write_buf += text
@@ -690,6 +1932,9 @@ class UpdatingLine:
 		if self.closed:
 			return
 		DotPrinterSlots.lock()
+		DotPrinterSlots.collectPosted()
+		if self in DotPrinterSlots.dirty:
+			DotPrinterSlots.renderFrame()
 		if msg is True:
 			msg = self.buf
 		elif msg is None:
@@ -708,8 +1953,86 @@ class UpdatingLine:
 _DOT='▒'
 _DOT_EIGHTHS = ['▏', '▎', '▍', '▌', '▋', '▊', '▉', '█']
 
+def _plain_cells(text):
+	cells = text_cells(text)
+	if cells is None:
+		cells = [ ('', x) for x in text ]
+	return cells
+
+def _place_cells(cells, idx, new):
+	"""
+	Puts new at index idx of a list of cells, padding with blanks or
+	chopping off whatever's in the way as needed.
+	"""
+	if len(cells) < idx:
+		cells.extend([('', ' ')] * (idx - len(cells)))
+	else:
+		del cells[idx:]
+	cells.extend(new)
+
+def gradient_color(frac):
+	"""
+	Returns the '#rrggbb' color of the DotPrinter gradient at position
+	frac (0.0 - 1.0) along the bar.
+	"""
+	import colorsys
+	s_thresh = 0.83333333333333333333
+	h = frac
+	s = 1.0
+	if frac >= s_thresh:
+		s = 1.0 - ((frac - s_thresh) / (1.0 - s_thresh))
+	v = 1.0
+	return '#' + ''.join([ "{:02x}".format(x) for x in [ x if x <= 255 else 255 for x in [ int(x * 255) for x in colorsys.hsv_to_rgb(h, s, v) ] ] ])
+
+@functools.lru_cache(maxsize=16)
+def gradient_palette(width, fgfunc):
+	"""
+	Returns a tuple of color escape sequences, one for each column of a
+	width-column DotPrinter bar, as produced by fgfunc (one of the
+	fabulous foreground color functions).
+
+	Results are cached, as they only change when the terminal is resized.
+	sigwinchHook() clears the cache.
+	"""
+	palette = []
+	color_step = 1 / width
+	for i in range(width):
+		cells = text_cells(str(fgfunc(gradient_color(i * color_step), ' ')))
+		palette.append(cells[0][0] if cells else '')
+	return tuple(palette)
+
+_si_prefixes = ['', 'k', 'M', 'G', 'T', 'P', 'E']
+
+def format_rate(rate, unit='it'):
+	"""
+	Formats a per-second rate with an SI prefix, like " 12.3 kB/s". The
+	result is always the same width for a given unit.
+	"""
+	width = 5 + 1 + 1 + len(unit) + 2
+	if rate is None:
+		return "--- {}/s".format(unit).rjust(width)
+	prefix = 0
+	while abs(rate) >= 999.95 and prefix < len(_si_prefixes) - 1:
+		rate /= 1000.0
+		prefix += 1
+	return "{:5.1f} {}{}/s".format(rate, _si_prefixes[prefix], unit).rjust(width)
+
+def format_eta(seconds):
+	"""
+	Formats a number of seconds as m:ss or h:mm:ss, or "--:--" if it's
+	unknown (None) or silly.
+	"""
+	if seconds is None or seconds >= 100 * 3600:
+		return "--:--"
+	seconds = int(seconds + 0.5)
+	hours, rem = divmod(seconds, 3600)
+	minutes, seconds = divmod(rem, 60)
+	if hours > 0:
+		return "{}:{:02}:{:02}".format(hours, minutes, seconds)
+	return "{}:{:02}".format(minutes, seconds)
+
 class DotPrinter(object):
-	def __init__(self, maxcount, showcount=False, label=None, afterlabel=None, countjustify=0, grouping=True, dotchar=_DOT, frac_dots=True, frac_dotchars=_DOT_EIGHTHS, colors=True, clear_on_close=False):
+	def __init__(self, maxcount, showcount=False, label=None, afterlabel=None, countjustify=0, grouping=True, dotchar=_DOT, frac_dots=True, frac_dotchars=_DOT_EIGHTHS, colors=True, clear_on_close=False, showrate=False, showeta=False, rate_unit='it', rate_smoothing=3.0, rate_interval=0.5):
 		locale.setlocale(locale.LC_ALL, locale.getdefaultlocale())
 		# currcount is used to track our progress.
 		self.currcount = 0
@@ -728,6 +2051,26 @@ class DotPrinter(object):
 		self.countjustify = countjustify
 		# If grouping is True, commas are put in the count display.
 		self.grouping = grouping
+		# If showrate is True, the rate of progress is displayed, in
+		# rate_unit per second. If showeta is True, so is the estimated
+		# time remaining.
+		self.showrate = showrate
+		self.showeta = showeta
+		self.rate_unit = rate_unit
+		# The rate is an exponentially weighted moving average, with a time
+		# constant of rate_smoothing seconds. It's sampled when the row gets
+		# drawn, at most every rate_interval seconds, rather than on every
+		# update(), so it doesn't cost anything when nothing's being drawn.
+		self.rate_smoothing = rate_smoothing
+		self.rate_interval = rate_interval
+		# Smoothed items per second, or None until the first sample.
+		self.rate = None
+		# Count and time at the last sample, and when the next one is due.
+		self.rate_count = 0
+		self.rate_time = monotonic()
+		self.rate_next = 0.0
+		self.rate_text = format_rate(None, self.rate_unit)
+		self.eta_text = format_eta(None)
 		if not DotPrinterSlots.init_complete:
 			DotPrinterSlots.init()
 		self.dotfile = DotPrinterSlots.dotfile
@@ -741,9 +2084,6 @@ class DotPrinter(object):
 		self.frac_dot_qty = len(frac_dotchars)
 		self.colors = colors
 		self.clear_on_close = clear_on_close
-		DotPrinterSlots.lock()
-		DotPrinterSlots.register(self)
-		DotPrinterSlots.release()
 		if self.colors:
 			import jlib
 			fab = jlib.get_fabulous(force=True)
@@ -751,19 +2091,34 @@ class DotPrinter(object):
 				self.fgfunc = fab['fgtrue']
 			else:
 				self.fgfunc = fab['fg256']
-	def refresh(self, activate=True, flush=True):
-		import jlib
-		if activate:
-			DotPrinterSlots.setActive(self)
+		# Items per dot in the current layout, or None if there's no bar.
+		# Set by render_cells().
+		self.bar_itemsperdot = None
+		# signature() of what's on screen. update() doesn't bother redrawing
+		# if it wouldn't change.
+		self.drawn = None
+		DotPrinterSlots.lock()
+		DotPrinterSlots.register(self)
+		DotPrinterSlots.release()
+	def render_cells(self):
+		"""
+		Lays out the DotPrinter's row, returning it as a list of cells
+		(see text_cells()).
+		"""
 		#    1/1024 whatever.h [                                   ]
 		cols, rows = Term.size
 		self.dotstart = 1
 		self.dotend = cols
+		# Only published to self.bar_itemsperdot once the layout's done, as
+		# update() reads it without the lock.
+		bar_itemsperdot = None
+		afterlabel_cells = None
 		if self.afterlabel is not None:
-			labelsize = len(" {}".format(self.afterlabel))
-			self.dotend -= labelsize
+			afterlabel_cells = _plain_cells(" {}".format(self.afterlabel))
+			self.dotend -= len(afterlabel_cells)
+		afterlabel_start = self.dotend
 
-		self.dotfile.write((jlib.encapsulate_ansi('erase_line') + jlib.encapsulate_ansi('cursor_horizontal_absolute', ['1']) + jlib.encapsulate_ansi('disable_line_wrap')).encode())
+		cells = []
 		if self.showcount:
 			maxcount_len = len(("{:n}" if self.grouping else "{}").format(self.maxcount))
 			if self.countjustify is not None and maxcount_len < self.countjustify:
@@ -773,39 +2128,40 @@ class DotPrinter(object):
 			self.maxcountsize = maxcount_len
 			self.countstart = self.dotstart
 			self.dotstart += countsize
-			self.dotfile.write((("{:n}" if self.grouping else "{}").format(self.currcount).rjust(self.maxcountsize, ' ') + '/' + ("{:n}" if self.grouping else "{}").format(self.maxcount).rjust(self.maxcountsize, ' ') + ' ').encode())
+			cells.extend(_plain_cells(("{:n}" if self.grouping else "{}").format(self.currcount).rjust(self.maxcountsize, ' ') + '/' + ("{:n}" if self.grouping else "{}").format(self.maxcount).rjust(self.maxcountsize, ' ') + ' '))
+
+		if self.showrate or self.showeta:
+			now = monotonic()
+			if now >= self.rate_next:
+				self.sample_rate(now)
+				self.rate_next = now + self.rate_interval
+			fields = ''
+			if self.showrate:
+				fields += self.rate_text + ' '
+			if self.showeta:
+				fields += "ETA " + self.eta_text.rjust(8) + ' '
+			field_cells = _plain_cells(fields)
+			self.dotstart += len(field_cells)
+			cells.extend(field_cells)
 
 		if self.label is not None:
-			labelsize = len("{} ".format(self.label))
-			self.dotstart += labelsize
-			self.dotfile.write((self.label + ' ').encode())
-		if self.afterlabel is not None:
-			self.dotfile.write((jlib.encapsulate_ansi('cursor_horizontal_absolute', ["{}".format(self.dotend + 1)]) + ' ' + self.afterlabel).encode())
+			label_cells = _plain_cells("{} ".format(self.label))
+			self.dotstart += len(label_cells)
+			cells.extend(label_cells)
 		self.dotstoprint = self.dotend - self.dotstart - 1
 		if self.dotstoprint == 0:
 			# cop-out zero-div mitigation
 			self.dotstoprint += 1
 		if self.colors:
-			import colorsys
-			color_step = 1 / self.dotstoprint
-			def colorcalc(frac):
-				s_thresh = 0.83333333333333333333
-				h = frac
-				s = 1.0
-				if frac >= s_thresh:
-					s = 1.0 - ((frac - s_thresh) / (1.0 - s_thresh))
-				v = 1.0
-				fgc = '#' + ''.join([ "{:02x}".format(x) for x in [ x if x <= 255 else 255 for x in [ int(x * 255) for x in colorsys.hsv_to_rgb(h, s, v) ] ] ])
-				return fgc
+			palette = gradient_palette(self.dotstoprint, self.fgfunc)
+			palette_end = len(palette) - 1
 		if self.maxcount < self.dotstoprint:
 			self.dotstoprint = self.maxcount
 			self.dotend = self.dotstart + self.dotstoprint + 1
 		if self.dotstoprint > 0:
-			self.dotfile.write('['.encode())
-			self.dotfile.write(jlib.encapsulate_ansi('cursor_horizontal_absolute', ["{}".format(self.dotend)]).encode())
-			self.dotfile.write(']'.encode())
-			self.dotfile.write(jlib.encapsulate_ansi('cursor_horizontal_absolute', ["{}".format(self.dotstart + 1)]).encode())
+			_place_cells(cells, self.dotstart - 1, [('', '[')])
 			self.itemsperdot = (float(self.maxcount) / float(self.dotstoprint))
+			bar_itemsperdot = self.itemsperdot
 			dotnum = int(self.currcount / self.itemsperdot)
 			self.dotsprinted = 0
 			self.frac_dot_printed = 0
@@ -815,12 +2171,11 @@ class DotPrinter(object):
 				if self.frac_dots:
 					to_print = self.frac_dotchars[-1]
 				else:
-					to_print = self.frac_dotchars[self.dotchar]
+					to_print = self.dotchar
 				if self.colors:
-					fgc = colorcalc(self.dotsprinted * color_step)
-					self.dotfile.write(str(self.fgfunc(fgc, to_print)).encode())
+					cells.append((palette[min(self.dotsprinted, palette_end)], to_print))
 				else:
-					self.dotfile.write(to_print.encode())
+					cells.append(('', to_print))
 				self.dotsprinted += 1
 			if self.frac_dots:
 				dot_remainder = self.currcount % self.itemsperdot
@@ -828,18 +2183,92 @@ class DotPrinter(object):
 				self.frac_dot_printed = int((dot_remainder / self.itemsperdot) * self.frac_dot_qty) - 1
 				if self.frac_dot_printed > -1:
 					if self.colors:
-						fgc = colorcalc(self.dotsprinted * color_step)
-						self.dotfile.write(str(self.fgfunc(fgc, self.frac_dotchars[self.frac_dot_printed])).encode())
+						cells.append((palette[min(self.dotsprinted, palette_end)], self.frac_dotchars[self.frac_dot_printed]))
 					else:
-						self.dotfile.write(self.frac_dotchars[self.frac_dot_printed].encode())
-		self.dotfile.write(jlib.encapsulate_ansi('enable_line_wrap').encode())
+						cells.append(('', self.frac_dotchars[self.frac_dot_printed]))
+			_place_cells(cells, self.dotend - 1, [('', ']')])
+		if afterlabel_cells is not None:
+			_place_cells(cells, afterlabel_start, afterlabel_cells)
+		self.bar_itemsperdot = bar_itemsperdot
+		self.drawn = self.signature(self.currcount)
+		return cells
+	def sample_rate(self, now):
+		"""
+		Folds the progress made since the last sample into the smoothed
+		rate, and updates the rate and ETA text to match.
+		"""
+		elapsed = now - self.rate_time
+		if elapsed < 0.001:
+			return
+		instant = (self.currcount - self.rate_count) / elapsed
+		if self.rate is None:
+			self.rate = instant
+		else:
+			# Weighting by elapsed time keeps the smoothing the same no
+			# matter how often we get sampled.
+			alpha = 1.0 - math.exp(-elapsed / self.rate_smoothing)
+			self.rate += alpha * (instant - self.rate)
+		self.rate_time = now
+		self.rate_count = self.currcount
+		self.rate_text = format_rate(self.rate, self.rate_unit)
+		remaining = self.maxcount - self.currcount
+		if remaining <= 0:
+			self.eta_text = format_eta(0)
+		elif self.rate > 0:
+			self.eta_text = format_eta(remaining / self.rate)
+		else:
+			self.eta_text = format_eta(None)
+	def signature(self, count):
+		"""
+		Returns a tuple of everything about the row that depends on the
+		count (dot index, fractional dot glyph, count display), for the
+		layout worked out by the last render_cells(). If it's the same for
+		two counts, so is the row. With rate or ETA fields, whether they're
+		due to be resampled counts too.
+		"""
+		# Read once, since render_cells() may be changing it in another
+		# thread.
+		itemsperdot = self.bar_itemsperdot
+		if itemsperdot is None:
+			dotnum = None
+			frac = None
+		else:
+			dotnum = int(count / itemsperdot)
+			frac = -1
+			if self.frac_dots:
+				frac = int(((count % itemsperdot) / itemsperdot) * self.frac_dot_qty) - 1
+		due = False
+		if self.showrate or self.showeta:
+			due = monotonic() >= self.rate_next
+		return (dotnum, frac, count if self.showcount else None, due)
+	def refresh(self, activate=True, flush=True):
+		if DotPrinterSlots.stack_erased:
+			return
+		if activate:
+			DotPrinterSlots.setActive(self)
+		self.dotfile.write(DotPrinterSlots.screen(self).render(self.render_cells(), Term.size[0]))
 		if flush:
 			self.dotfile.flush()
 	def update(self, newcount, flush=True):
+		if DotPrinterSlots.render_stats is not None:
+			DotPrinterSlots.render_stats.updates += 1
+		if self.drawn is not None and self.signature(newcount) == self.drawn:
+			# Nothing visible would change, so don't bother. (If a redraw
+			# is already pending, it'll pick up the new count.)
+			self.currcount = newcount
+			return
+		if DotPrinterSlots.renderer is not None:
+			self.currcount = newcount
+			DotPrinterSlots.post(self)
+			return
 		DotPrinterSlots.lock()
-		DotPrinterSlots.setActive(self)
 		self.currcount = newcount
-		self.refresh()
+		if DotPrinterSlots.fps is not None:
+			DotPrinterSlots.markDirty(self)
+			DotPrinterSlots.release()
+			return
+		DotPrinterSlots.setActive(self)
+		DotPrinterSlots.refreshSlot(self)
 		#if self.dotstoprint > 0:
 		#	dotnum = int(self.currcount / self.itemsperdot)
 		#	if self.frac_dots:
@@ -875,6 +2304,14 @@ class DotPrinter(object):
 		DotPrinterSlots.line(*values, sep=sep, end=end, file=file, printfile=printfile)
 	def close(self, printlabel=True, text=None):
 		DotPrinterSlots.lock()
+		if self not in DotPrinterSlots.slots:
+			# Already closed, or __init__ never got as far as register()
+			# (say, because jlib couldn't be imported).
+			DotPrinterSlots.release()
+			return
+		DotPrinterSlots.collectPosted()
+		if self in DotPrinterSlots.dirty:
+			DotPrinterSlots.renderFrame()
 		if not self.clear_on_close:
 			if printlabel:
 				msg = StringIO()
@@ -894,12 +2331,114 @@ class DotPrinter(object):
 		DotPrinterSlots.deregister(self, text) 
 		DotPrinterSlots.release()
 	def activation_cb(self):
-		import jlib
-		self.dotfile.write(jlib.encapsulate_ansi('cursor_horizontal_absolute', ["{}".format(self.dotstart + 1 + self.dotsprinted)]).encode())
+		self.dotfile.write(ansi_param('cursor_horizontal_absolute', self.dotstart + 1 + self.dotsprinted))
 	def __del__(self):
 		if sys.meta_path is not None:
 			self.close()
 
+class ProgressCounter(object):
+	"""
+	The child process end of a ProgressAggregator. Has the same update()
+	method as a DotPrinter, except all it does is store the count in
+	shared memory, so it's safe to use from any process.
+	"""
+	def __init__(self, counts, idx):
+		self.counts = counts
+		self.idx = idx
+	def update(self, newcount, flush=True):
+		self.counts[self.idx] = newcount
+	def add(self, amount=1):
+		self.counts[self.idx] += amount
+	def close(self, *args, **kwargs):
+		pass
+
+class ProgressAggregator(object):
+	"""
+	Displays progress for a bunch of worker processes, without any of them
+	touching the terminal.
+
+	Each worker gets a slot in a shared memory array of counts, which it
+	writes to with a ProgressCounter. The parent process reads the whole
+	array once per frame (from the DotPrinterSlots renderer thread, which
+	this starts) and updates either one DotPrinter per worker, or, if
+	summed is True, a single DotPrinter showing the total.
+
+	The array has to reach the workers when they're started, as opposed to
+	being sent along with a task, so hand it over through Process args or a
+	Pool initializer:
+
+		agg = JaysTerm.ProgressAggregator(64, 1000, label="worker {}")
+		def init(counts):
+			global counts_shm
+			counts_shm = counts
+		def work(idx):
+			counter = JaysTerm.ProgressCounter(counts_shm, idx)
+			for i in range(1000):
+				...
+				counter.update(i + 1)
+		with multiprocessing.Pool(8, initializer=init, initargs=(agg.counts,)) as pool:
+			pool.map(work, range(64))
+		agg.close()
+
+	maxcount is either the same for every worker, or a list with one per
+	worker. label is formatted with the worker index, unless summed is True,
+	in which case it's used as is. Any other keyword
+	arguments go to the DotPrinter(s).
+	"""
+	def __init__(self, workers, maxcount, label=None, summed=False, fps=30, **kwargs):
+		import multiprocessing
+		self.workers = workers
+		if isinstance(maxcount, int):
+			maxcount = [maxcount] * workers
+		self.maxcounts = list(maxcount)
+		self.summed = summed
+		# No lock; each slot only has the one writer.
+		self.counts = multiprocessing.Array('q', workers, lock=False)
+		self.last = [0] * workers
+		if self.summed:
+			self.printers = [DotPrinter(sum(self.maxcounts), label=label, **kwargs)]
+		else:
+			self.printers = [ DotPrinter(self.maxcounts[i], label=None if label is None else label.format(i), **kwargs) for i in range(workers) ]
+		self.closed = False
+		DotPrinterSlots.frame_hooks.append(self.poll)
+		# If somebody else already has the renderer going, it's theirs to
+		# stop; otherwise close() puts things back the way they were.
+		self.started_renderer = DotPrinterSlots.renderer is None
+		self.prev_fps = DotPrinterSlots.fps
+		DotPrinterSlots.startRenderer(fps)
+	def counter(self, idx):
+		"""
+		Returns a ProgressCounter for worker idx.
+		"""
+		return ProgressCounter(self.counts, idx)
+	def poll(self):
+		"""
+		Picks up any changes the workers have made, and passes them on to the
+		DotPrinter(s). Called by the renderer thread every frame.
+		"""
+		current = self.counts[:]
+		if current == self.last:
+			return
+		if self.summed:
+			self.printers[0].update(sum(current))
+		else:
+			for i in range(self.workers):
+				if current[i] != self.last[i]:
+					self.printers[i].update(current[i])
+		self.last = current
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		if self.poll in DotPrinterSlots.frame_hooks:
+			DotPrinterSlots.frame_hooks.remove(self.poll)
+		if self.started_renderer:
+			DotPrinterSlots.stopRenderer()
+			DotPrinterSlots.setFps(self.prev_fps)
+		self.poll()
+		for x in self.printers:
+			x.close()
+
 # Note: You may be tempted to wrap EditingLine.poll() around a select() or
 # poll() object in order to cut down on busy sleeps... be sure to call
 # the EditingLine instance's poll() object at least once beforehand, in order
@@ -913,15 +2452,44 @@ class DotPrinter(object):
 #	l.poll()
 #	keepGoing = True
 #	while keepGoing:
-#		resp = p.poll(1000)
-#		for fd, typ in resp:
-#			if fd == sys.stdin.fileno():
-#				resp2 = l.poll()
-#				if (resp2):
-#					msg = l.getBuf()
-#					l.close(msg)
-#					keepGoing = False
-#					break
+#		# Input that came in after an enter waits in Term's buffer, which
+#		# p.poll() can't see, so only block if there's none of that.
+#		if Term.pending() < 1:
+#			p.poll(1000)
+#		while l.readable():
+#			if l.poll():
+#				msg = l.getBuf()
+#				l.close(msg)
+#				keepGoing = False
+#				break
+#
+# Under asyncio, readline() takes care of all that for you:
+#	l = EditingLine(history=['poop', 'shit', 'crappola'])
+#	msg = await l.readline()
+#	l.close(msg)
+
+class InputDecoder(object):
+	"""
+	Streaming decoder for terminal input.
+
+	Feed it chunks of bytes with decode(), and it hands back whatever
+	complete characters they contain, holding on to any trailing partial
+	character until the rest of it shows up. Invalid or truncated
+	sequences come out as U+FFFD rather than raising.
+
+	Used by EditingLine, and can be handed to TerminalSequenceParser.
+	"""
+	def __init__(self, encoding='utf-8', errors='replace'):
+		self.decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+	def decode(self, data, final=False):
+		return self.decoder.decode(data, final)
+	def pending(self):
+		"""
+		Returns the bytes of an incomplete character being held on to.
+		"""
+		return self.decoder.getstate()[0]
+	def reset(self):
+		self.decoder.reset()
 
 def count_significant_bits(byte):
 	count = 0
@@ -979,16 +2547,16 @@ terminal_sequences = """
 * ESC [ 1 ; 6 A — shift +  ctrl + up arrow
 * ESC [ 1 ; 6 B — shift +  ctrl + down arrow
 * ESC [ 1 ; 6 C — shift +  ctrl + right arrow
-* ESC [ 1 ; 6 D — shift +  ctrrl + left arrow
+* ESC [ 1 ; 6 D — shift +  ctrl + left arrow
 * ESC [ 1 ; 7 C —  ctrl +  alt  + right arrow
 * ESC [ 1 ; 7 D —  ctrl +  alt  + left arrow
 * ESC [ 1 ; 8 C — shift +  ctrl +  alt + right arrow
-* ESC [ 1 ; 8 C — shift +  ctrl +  alt + left arrow
+* ESC [ 1 ; 8 D — shift +  ctrl +  alt + left arrow
 * ESC [ 1 ; 3 H —  alt  + home
 * ESC [ 1 ; 3 F —  alt  + end
-* ESC [ 1 ; 5 H — shift +  home
-* ESC [ 1 ; 5 F — shift +  end
-* ESC [ 1 ; 7 H —  ctrl +  alt  + end
+* ESC [ 1 ; 5 H —  ctrl +  home
+* ESC [ 1 ; 5 F —  ctrl +  end
+* ESC [ 1 ; 7 H —  ctrl +  alt  + home
 * ESC [ 1 ; 7 F —  ctrl +  alt  + end
 
 * ESC O P — f1   
@@ -1076,6 +2644,118 @@ def generate_terminal_code_lut():
 		lut[buf] = keyspressed
 	return [treelut, lut]
 
+_terminal_code_lut = None
+def terminal_code_lut():
+	"""
+	Returns the same [treelut, lut] pair as generate_terminal_code_lut(),
+	except it's only built the first time it's needed, and shared from then
+	on. Treat the results as read-only.
+	"""
+	global _terminal_code_lut
+	if _terminal_code_lut is None:
+		_terminal_code_lut = generate_terminal_code_lut()
+	return _terminal_code_lut
+
+# Keys that show up as ESC [ <number> ; <modifiers> ~
+csi_tilde_keys = {
+	2:  'insert',
+	3:  'delete',
+	5:  'page up',
+	6:  'page down',
+	15: 'f5',
+	17: 'f6',
+	18: 'f7',
+	19: 'f8',
+	20: 'f9',
+	21: 'f10',
+	23: 'f11',
+	24: 'f12',
+}
+# Keys that show up as ESC [ 1 ; <modifiers> <letter>
+csi_letter_keys = {
+	b'A': 'up arrow',
+	b'B': 'down arrow',
+	b'C': 'right arrow',
+	b'D': 'left arrow',
+	b'H': 'home',
+	b'F': 'end',
+	b'P': 'f1',
+	b'Q': 'f2',
+	b'R': 'f3',
+	b'S': 'f4',
+}
+# Names for the codepoints in modifyOtherKeys / CSI u sequences that aren't
+# printable characters.
+csi_codepoint_keys = {
+	9:   'tab',
+	13:  'enter',
+	27:  'escape',
+	127: 'backspace',
+}
+# xterm encodes modifiers as 1 + a bitmask of these.
+csi_modifier_bits = [
+	(1, 'shift'),
+	(2, 'alt'),
+	(4, 'ctrl'),
+	(8, 'meta'),
+]
+def codepoint_key(code):
+	"""
+	Returns the key name for a codepoint from a modifyOtherKeys / CSI u
+	sequence, or None if it isn't a valid character.
+	"""
+	if code in csi_codepoint_keys:
+		return csi_codepoint_keys[code]
+	if code > 0x10ffff or 0xd800 <= code <= 0xdfff:
+		return None
+	return chr(code)
+_csi_params_pat = re.compile(b"^\x1b\\[([0-9;]*)([~A-DFHP-Su])$")
+
+def decode_csi(seq):
+	"""
+	Decodes an xterm-style modified key sequence generically, returning a
+	frozenset like the ones in the terminal_sequences table, or None if
+	seq isn't one. Handles:
+
+	* ESC [ n ; m ~           (insert, delete, page up/down, f5-f12)
+	* ESC [ 1 ; m X           (arrows, home, end, f1-f4)
+	* ESC [ 27 ; m ; code ~   (xterm modifyOtherKeys)
+	* ESC [ code ; m u        (kitty / "CSI u")
+
+	where m is 1 + a bitmask of shift (1), alt (2), ctrl (4) and meta (8).
+	"""
+	mat = _csi_params_pat.match(seq)
+	if mat is None:
+		return None
+	try:
+		params = [ int(x) if len(x) > 0 else 1 for x in mat.group(1).split(b';') ] if len(mat.group(1)) > 0 else []
+	except ValueError:
+		return None
+	final = mat.group(2)
+	key = None
+	mods = 1
+	if final == b'~':
+		if len(params) == 3 and params[0] == 27:
+			mods = params[1]
+			key = codepoint_key(params[2])
+		elif len(params) in (1, 2) and params[0] in csi_tilde_keys:
+			key = csi_tilde_keys[params[0]]
+			if len(params) == 2:
+				mods = params[1]
+	elif final == b'u':
+		if len(params) in (1, 2):
+			key = codepoint_key(params[0])
+			if len(params) == 2:
+				mods = params[1]
+	elif len(params) == 2 and params[0] == 1:
+		key = csi_letter_keys[final]
+		mods = params[1]
+	if key is None or mods < 1:
+		return None
+	keys = [ name for bit, name in csi_modifier_bits if (mods - 1) & bit ]
+	keys.append(key)
+	return frozenset(keys)
+
 # * ESC <just about any character> -- alt + character
 #   * Yes, this DOES mean "alt + [, A" is the same as hitting the up arrow.
 
@@ -1089,14 +2769,34 @@ class CursorPosition:
 	def __repr__(self):
 		return "<CursorPosition row:{} col:{}>".format(self.row, self.col)
 
+class Paste:
+	"""
+	Something the user pasted while bracketed paste was on, delivered by
+	TerminalSequenceParser all in one piece. text is a str if the parser
+	has a decoder, bytes otherwise.
+	"""
+	def __init__(self, text):
+		self.text = text
+	def __repr__(self):
+		return "<Paste len:{}>".format(len(self.text))
+
+paste_begin = b"\x1b[200~"
+paste_end = b"\x1b[201~"
+
+# A complete CSI or SS3 sequence, as found in terminal input.
+_input_seq_pat = re.compile(b"\x1b(?:\\[[0-?]*[ -/]*[@-~]|O[@-~])")
+# As much of the start of a CSI or SS3 sequence as is there.
+_input_seq_partial_pat = re.compile(b"\x1b(?:\\[[0-?]*[ -/]*|O)?")
+
 class TerminalSequenceParser:
 	"""
 	This thing makes a somewhat competent attempt to handle terminal input.
 
-	Instantiate it, and feed your key data to it, as binary bytes() data,
-	one character at a time.
+	Instantiate it, and feed your key data to it, as binary bytes() data.
+	You can either feed() it one character at a time, or hand parse() a
+	whole chunk of input at once.
 
-	What you'll get back depends on the internal state:
+	What you'll get back from feed() depends on the internal state:
 
 	* None — the parser encountered an escape character and is currently working voodoo.
 	       Continue to feed it characters until it comes back with something else, or
@@ -1108,63 +2808,306 @@ class TerminalSequenceParser:
 	       as a frozenset.
 	* something else — Special cases, such as the response to a "cursor position" request
 	       will get returned as some sort of object.
+
+	With bracketed paste turned on (see Term.enableBracketedPaste()), everything
+	between ESC [ 200 ~ and ESC [ 201 ~ comes back as a single Paste object,
+	however many chunks it arrives in.
+
+	parse() returns a list of the same sorts of things, except that runs of
+	ordinary input come back together as a single bytes object, rather than
+	one character at a time. Those never start with an escape; bytes
+	objects that do are sequences the parser gave up on. An incomplete
+	sequence at the end of the chunk is held on to until the next call.
+
+	Sequences are recognized with a precompiled state machine for the CSI
+	(ESC [ ...) and SS3 (ESC O ...) grammar, then looked up as a whole in
+	the terminal_sequences table, so there's no per-byte Python work outside
+	of escape sequences.
+
+	If you hand it an InputDecoder (such as the one belonging to an EditingLine),
+	ordinary input gets run through that and comes back as a str instead of bytes,
+	with None being returned while a multibyte character is still incomplete.
 	"""
-	def __init__(self):
-		import re
-		self.lut = generate_terminal_code_lut()[1]
-		# Note: Request cursor position by issuing "\x1b[?6n", not "\x1b[6n", as the reply from the latter
-		# command can mimic ctrl+f3 in certain cases.
-		self.patterns = [
-			[re.compile(b"^\x1b\[\?(?P<row>\d+);(?P<col>\d+);1R$"), lambda x: CursorPosition.from_match(x)],
-		]
+	# Note: Request cursor position by issuing "\x1b[?6n", not "\x1b[6n", as the reply from the latter
+	# command can mimic ctrl+f3 in certain cases.
+	patterns = [
+		[re.compile(b"^\x1b\\[\\?(?P<row>\\d+);(?P<col>\\d+);1R$"), lambda x: CursorPosition.from_match(x)],
+	]
+	def __init__(self, decoder=None):
+		self.decoder = decoder
+		# Shared between all parsers, so making lots of them is cheap.
+		self.lut = terminal_code_lut()[1]
 		self.buf = b''
+		# Accumulates the contents of a bracketed paste until its end
+		# marker shows up. None when we're not in the middle of one.
+		self.paste = None
 	def feed(self, char):
-		ret = char
-		if len(self.buf) < 1:
-			if char == b"\x1b":
-				self.buf += char
-				ret = None
+		events = self.parse(char)
+		if len(events) < 1:
+			return None
+		return events[0]
+	def parse(self, data):
+		"""
+		Parses a chunk of input, returning a list of everything found in it.
+		"""
+		if len(self.buf) > 0:
+			data = self.buf + data
+			self.buf = b''
+		events = []
+		pos = 0
+		end = len(data)
+		while pos < end:
+			if self.paste is not None:
+				pos = self.add_paste(events, data, pos)
+				continue
+			esc = data.find(b"\x1b", pos)
+			if esc < 0:
+				esc = end
+			if esc > pos:
+				self.add_text(events, data[pos:esc])
+				pos = esc
+				continue
+			mat = _input_seq_pat.match(data, pos)
+			if mat is not None:
+				seq = mat.group(0)
+				pos = mat.end()
+				if seq == paste_begin:
+					self.paste = bytearray()
+				else:
+					events.append(self.lookup(seq))
+				continue
+			# Not a complete sequence. If we ran out of input, wait for
+			# more, otherwise give up on it, up to and including the first
+			# character that doesn't fit.
+			stop = _input_seq_partial_pat.match(data, pos).end()
+			if stop >= end:
+				self.buf = data[pos:]
+				break
+			events.append(data[pos:stop + 1])
+			pos = stop + 1
+		return events
+	def add_paste(self, events, data, pos):
+		"""
+		Consumes bracketed paste contents from data, starting at pos,
+		appending a Paste to events once the end marker is found. Returns
+		the position to carry on parsing from.
+		"""
+		idx = data.find(paste_end, pos)
+		if idx < 0:
+			# Hang on to anything at the end that could be the start of the
+			# end marker, and wait for more.
+			end = len(data)
+			keep = 0
+			for size in range(min(len(paste_end) - 1, end - pos), 0, -1):
+				if data.endswith(paste_end[:size]):
+					keep = size
+					break
+			self.paste += data[pos:end - keep]
+			self.buf = data[end - keep:]
+			return end
+		self.paste += data[pos:idx]
+		text = bytes(self.paste)
+		self.paste = None
+		if self.decoder is not None:
+			text = self.decoder.decode(text)
+		events.append(Paste(text))
+		return idx + len(paste_end)
+	def paste_end_offset(self, data):
+		"""
+		If we're in the middle of a bracketed paste, and the next chunk of
+		input, data, has the end marker in it, returns the offset just past
+		the marker. Otherwise returns None.
+		"""
+		if self.paste is None:
+			return None
+		# Part of the marker may already be sitting in buf.
+		idx = (self.buf + data).find(paste_end)
+		if idx < 0:
+			return None
+		return idx + len(paste_end) - len(self.buf)
+	def add_text(self, events, data):
+		if self.decoder is None:
+			events.append(data)
 		else:
-			ret = None
-			self.buf += char
-			charval = ord(char)
-			if charval >= 48 and charval <= 57:
-				pass
-			elif char in b';[?':
-				pass
-			else:
-				ret = self.buf
-				self.buf = b''
-		if ret is not None and len(ret) > 1:
-			if ret in self.lut:
-				ret = self.lut[ret]
-			else:
-				for pat, act in self.patterns:
-					mat = pat.search(ret)
-					if mat:
-						ret = act(mat)
+			text = self.decoder.decode(data)
+			if len(text) > 0:
+				events.append(text)
+	def lookup(self, seq):
+		"""
+		Translates a complete escape sequence into whatever it represents.
+		"""
+		if seq in self.lut:
+			return self.lut[seq]
+		for pat, act in self.patterns:
+			mat = pat.search(seq)
+			if mat:
+				return act(mat)
+		keys = decode_csi(seq)
+		if keys is not None:
+			return keys
+		return seq
+	def abort(self):
+		"""
+		Gives up on any partial escape sequence or bracketed paste,
+		returning its bytes.
+		"""
+		ret, self.buf = self.buf, b''
+		if self.paste is not None:
+			ret = paste_begin + bytes(self.paste) + ret
+			self.paste = None
 		return ret
-		
 
 
+
+class GapBuffer(object):
+	"""
+	Text storage for line editing.
+
+	Characters are kept in a list with a "gap" of unused slots at the edit
+	point, so inserting or deleting at (or near) the cursor only shuffles
+	the characters between the old and new edit points, rather than
+	rebuilding the whole string. The str() of the buffer is built on
+	demand and cached until the next edit.
+
+	If widths is True, the display width of every character is tracked
+	alongside it, along with the total width of everything in front of the
+	gap. Since the gap sits at the cursor most of the time, that makes
+	width_to() for the cursor position O(1).
+	"""
+	def __init__(self, text='', gap=64, widths=False):
+		self.mingap = gap
+		self.widths = widths
+		self.set(text)
+	@staticmethod
+	def char_widths(text):
+		return [ max(wcwidth.wcwidth(x), 0) for x in text ]
+	def set(self, text):
+		"""
+		Replaces the contents of the buffer, leaving the gap at the end.
+		"""
+		self.buf = list(text) + [None] * self.mingap
+		self.gap_start = len(text)
+		self.gap_end = len(self.buf)
+		self.text = text
+		if self.widths:
+			self.wbuf = self.char_widths(text) + [0] * self.mingap
+			self.gap_width = sum(self.wbuf)
+			self.total_width = self.gap_width
+	def __len__(self):
+		return len(self.buf) - (self.gap_end - self.gap_start)
+	def __str__(self):
+		if self.text is None:
+			self.text = ''.join(self.buf[:self.gap_start]) + ''.join(self.buf[self.gap_end:])
+		return self.text
+	def move_gap(self, pos):
+		if pos < self.gap_start:
+			count = self.gap_start - pos
+			self.buf[self.gap_end - count:self.gap_end] = self.buf[pos:self.gap_start]
+			if self.widths:
+				moved = self.wbuf[pos:self.gap_start]
+				self.wbuf[self.gap_end - count:self.gap_end] = moved
+				self.gap_width -= sum(moved)
+			self.gap_start -= count
+			self.gap_end -= count
+		elif pos > self.gap_start:
+			count = pos - self.gap_start
+			self.buf[self.gap_start:pos] = self.buf[self.gap_end:self.gap_end + count]
+			if self.widths:
+				moved = self.wbuf[self.gap_end:self.gap_end + count]
+				self.wbuf[self.gap_start:pos] = moved
+				self.gap_width += sum(moved)
+			self.gap_start += count
+			self.gap_end += count
+	def width_to(self, pos):
+		"""
+		Returns the display width of the first pos characters. Requires
+		widths=True. Moves the gap to pos, so this is cheap at the cursor.
+		"""
+		self.move_gap(pos)
+		return self.gap_width
+	def insert(self, pos, text):
+		"""
+		Inserts text at character position pos.
+		"""
+		count = len(text)
+		if count < 1:
+			return
+		self.move_gap(pos)
+		if self.gap_end - self.gap_start < count:
+			grow = max(count, len(self.buf), self.mingap)
+			self.buf[self.gap_end:self.gap_end] = [None] * grow
+			if self.widths:
+				self.wbuf[self.gap_end:self.gap_end] = [0] * grow
+			self.gap_end += grow
+		self.buf[self.gap_start:self.gap_start + count] = text
+		if self.widths:
+			added = self.char_widths(text)
+			self.wbuf[self.gap_start:self.gap_start + count] = added
+			added = sum(added)
+			self.gap_width += added
+			self.total_width += added
+		self.gap_start += count
+		self.text = None
+	def delete(self, start, end):
+		"""
+		Deletes the characters from position start up to (but not including)
+		position end.
+		"""
+		if end <= start:
+			return
+		self.move_gap(end)
+		if self.widths:
+			removed = sum(self.wbuf[start:self.gap_start])
+			self.gap_width -= removed
+			self.total_width -= removed
+		self.gap_start = start
+		self.text = None
+	def slice(self, start, end=None):
+		"""
+		Returns the characters from position start up to (but not including)
+		position end as a string, without building the whole thing.
+		"""
+		length = len(self)
+		if end is None or end > length:
+			end = length
+		if start < 0:
+			start = 0
+		if start >= end:
+			return ''
+		gap = self.gap_end - self.gap_start
+		if end <= self.gap_start:
+			return ''.join(self.buf[start:end])
+		elif start >= self.gap_start:
+			return ''.join(self.buf[start + gap:end + gap])
+		return ''.join(self.buf[start:self.gap_start]) + ''.join(self.buf[self.gap_end:end + gap])
+
+# Where typed input gets cut up by EditingLine.feed().
+_line_end_pat = re.compile(b"[\n\r]")
+_paste_line_break_pat = re.compile("\r\n|[\r\n]")
+
 class EditingLine(object):
 	# Implementation notes:
-	# Internal buffers (escbuf, utf8buf, lastbyte, lastpoll) are bytes objects,
-	# as we need to retain and interpret escape characters, utf-8 fragments, and
-	# the like. The history list, however, consists of strings, because we need
-	# to calculate lengths in terms of printable characters... and at the end
-	# of the day, that's also what the user cares about and expects.
-	def __init__(self, history=[], prompt='', stdin=sys.stdin):
+	# Input comes in as bytes, and is run through a TerminalSequenceParser
+	# with an InputDecoder, which takes care of escape sequences, bracketed
+	# pastes, and hanging on to utf-8 fragments until they're complete.
+	# Everything after that (the parsed text, the history list) consists of strings,
+	# because we need to calculate lengths in terms of printable characters...
+	# and at the end of the day, that's also what the user cares about and
+	# expects. lastbyte and lastpoll remain bytes objects.
+	def __init__(self, history=[], prompt='', stdin=sys.stdin, bracketed_paste=True):
 		# This regex is used to cheese our ^W "kill last word" functionality...
 		import re
 		self.kill_word_pat = re.compile("^(.*\S)(\s+\S+\s*)$")
+		# Characters in typed input that need handling, rather than
+		# inserting into the line.
+		self.control_pat = re.compile("[\x01\x04\x05\x17\x7f\n\r]")
 		if not DotPrinterSlots.init_complete:
 			DotPrinterSlots.init()
 		self.dotfile = DotPrinterSlots.dotfile
 		self.printfile = DotPrinterSlots.printfile
 		self.stdin = stdin
 		Term.init()
-		Term.raw()
+		Term.beginRawInput()
 		self.write_buf = ''
 		# Note to future self:
 		# System is not happy AT ALL if you use the call that's commented out below.
@@ -1187,14 +3130,26 @@ class EditingLine(object):
 		else:
 			self.history.append('')
 		self.historypos = len(self.history) - 1
+		# The line currently visible / being edited lives here while we work
+		# on it. linedirty gets set whenever it has changes that haven't been
+		# copied back into the history list yet.
+		self.editbuf = GapBuffer(self.history[self.historypos], widths=True)
+		self.linedirty = False
+		# (prompt, display width of prompt), so we only measure it when it
+		# changes.
+		self.prompt_cache = (None, 0)
+		self.bracketed_paste = bracketed_paste
 		DotPrinterSlots.lock()
 		DotPrinterSlots.register(self)
 		DotPrinterSlots.preferred_slot = self
 		DotPrinterSlots.release()
+		if self.bracketed_paste:
+			Term.enableBracketedPaste(self.dotfile)
 		self.reset(history)
 		self.activation_cb()
 		#self.debugline = JaysTerm.UpdatingLine()
 	def reset(self, history=[], prompt=None):
+		self.sync()
 		self.history = history
 		if prompt is not None:
 			self.prompt = prompt
@@ -1204,20 +3159,15 @@ class EditingLine(object):
 			self.history.append('')
 		# The index of the line currently visible / being edited.
 		self.historypos = len(self.history) - 1
-		# This flag is set to indicate that we've received an escape byte,
-		# and are currently in the process of interpreting an escape sequence.
-		self.escmode = False
-		# bytes received while escmode is set are stored here until we have
-		# enough of them to interpret the sequence.
-		self.escbuf = b''	
+		self.editbuf.set(self.history[self.historypos])
 		self.cursorpos = 0
 		self.linewin = 0
-		# counter used when receiving a utf-8 character to track how many
-		# additional bytes we're expecting to see.
-		self.utf8bytesleft = 0
-		# bytes obtained while receiving a utf-8 character are stored here
-		# for safekeeping.
-		self.utf8buf = b''
+		# Turns incoming bytes into characters, keeping hold of partial
+		# utf-8 sequences between chunks.
+		self.decoder = InputDecoder()
+		# Splits input into text, keys and pastes, keeping hold of partial
+		# escape sequences between chunks.
+		self.parser = TerminalSequenceParser(self.decoder)
 		# Stores the last byte retrieved from stdin.
 		# If poll() is called with process_all_input set to False, this can
 		# be interrogated afterwards and you will be guaranteed to get hold of
@@ -1226,35 +3176,63 @@ class EditingLine(object):
 		self.lastpoll = b''
 		self.refresh()
 	def getBuf(self):
+		self.sync()
 		return self.history[self.historypos]
+	def sync(self):
+		"""
+		Copies any pending edits from editbuf back into the history list.
+		"""
+		if self.linedirty:
+			self.history[self.historypos] = str(self.editbuf)
+			self.linedirty = False
+	def goto_history(self, pos):
+		"""
+		Switches the line being edited to history item pos.
+		"""
+		self.sync()
+		self.historypos = pos
+		self.editbuf.set(self.history[self.historypos])
+	def edit(self):
+		"""
+		Called before the line is changed.
+		"""
+		if self.historypos != len(self.history) - 1:
+			# If not at the latest history position, go there.
+			# This has the effect of making the history copy-on-write.
+			# Which is desirable, because cows are desirable.
+			self.historypos = len(self.history) - 1
+		self.linedirty = True
+	def prompt_width(self):
+		if self.prompt_cache[0] is not self.prompt:
+			# Note: module "colors" is provided by the "ansicolors" package in pip.
+			import colors
+			self.prompt_cache = (self.prompt, len(colors.strip_color(self.prompt)))
+		return self.prompt_cache[1]
 	def position_cursor(self):
-		import jlib
-		# Note: module "colors" is provided by the "ansicolors" package in pip.
-		import colors, wcwidth
-		self.dotfile.write(jlib.encapsulate_ansi('cursor_horizontal_absolute', [str(len(colors.strip_color(self.prompt)) + wcwidth.wcswidth(self.history[self.historypos][:self.cursorpos]) - self.linewin + 1)]).encode())
+		self.dotfile.write(ansi_param('cursor_horizontal_absolute', self.prompt_width() + self.editbuf.width_to(self.cursorpos) - self.linewin + 1))
 	def refresh(self, activate=True, flush=True):
-		import jlib
-		# Note: module "colors" is provided by the "ansicolors" package in pip.
+		if DotPrinterSlots.stack_erased:
+			return
 		self.activation_cb()
-		import colors
 		colSize = Term.size[0]
 		if activate:
 			DotPrinterSlots.setActive(self)
 
 		# Clear the line 
-		self.dotfile.write((jlib.encapsulate_ansi('erase_line') + jlib.encapsulate_ansi('cursor_horizontal_absolute', ['1'])).encode())
+		self.dotfile.write(ansi_bytes['clear_line'])
+		avail = colSize - self.prompt_width()
 		# If the cursor position is to the left of the visible window,
 		# jump the window back in <winscroll>-sized chunks until we reach
 		# the cursor position.
-		while self.cursorpos < self.linewin:
-			self.linewin -= self.winscroll
+		if self.cursorpos < self.linewin:
+			self.linewin -= -(-(self.linewin - self.cursorpos) // self.winscroll) * self.winscroll
 			if self.linewin < 0:
 				self.linewin = 0
 		# If the cursor position is to the right of the visible window,
 		# jump the window forward.
-		while self.cursorpos > self.linewin + (colSize - len(colors.strip_color(self.prompt))):
-			self.linewin += self.winscroll
-		self.dotfile.write((self.prompt + self.history[self.historypos][self.linewin:self.linewin + (colSize - len(colors.strip_color(self.prompt)))]).encode())
+		if self.cursorpos > self.linewin + avail:
+			self.linewin += -(-(self.cursorpos - self.linewin - avail) // self.winscroll) * self.winscroll
+		self.dotfile.write((self.prompt + self.editbuf.slice(self.linewin, self.linewin + avail)).encode())
 		self.position_cursor()
 		if flush:
 			self.dotfile.flush()
@@ -1262,11 +3240,15 @@ class EditingLine(object):
 	def poll(self, process_all_input=True):
 		"""
 		Uses select.select() to determine readability of sys.stdin, and, if
-		true, calls Term.getkey() one or more times to retrieve and interpret
-		the user's input. Returns True if the user hit enter, indicating that
+		true, calls Term.getchunk() one or more times to retrieve and
+		interpret all of the user's available input, redrawing the line once
+		afterwards. Returns True if the user hit enter, indicating that
 		it's now time for you to call getbuf() to retrieve the culmination of
 		the user's efforts, and then perhaps reset() to prepare the next
 		iteration of the line editing experience... otherwise it returns False.
+		Any input following the enter is left for the next poll(), in Term's
+		buffer, where select() can't see it; check readable() before going
+		back to waiting on stdin.
 
 		If process_all_input is set to False, this method will return after
 		at most 1 byte is retrieved from stdin, allowing you to play along at
@@ -1278,126 +3260,194 @@ class EditingLine(object):
 		poll() will come back and self.lastbyte will remain unchanged if there
 		isn't any data to read in sys.stdin, so you'll want to prequalify
 		whether or not you want to call poll() with your own calls to
-		select.select() or the like.
+		select.select() or the like (and Term.pending()).
 		"""
-		ifh, ofh, xfh = select.select([self.stdin.fileno()], [], [], 0)
-		keepGoing = len(ifh) > 0
+		if not self.readable():
+			return False
+		entered = False
+		keepGoing = True
 		while keepGoing:
 			DotPrinterSlots.lock()
-			c = Term.getkey()
-			DotPrinterSlots.release()
-			self.lastbyte = c
-			if self.escmode:
-				if c == b'\x1b':
-					self.escmode = False
-					self.escbuf = b''
-					# do something here
+			try:
+				if process_all_input:
+					data = Term.getchunk()
 				else:
-					self.escbuf += c
-				if len(self.escbuf) > 1:
-					if self.escbuf == b'[A': # up
-						if self.historypos > 0:
-							self.historypos -= 1
-							self.cursorpos = len(self.history[self.historypos])
-					elif self.escbuf == b'[B': # down
-						if self.historypos < len(self.history) - 1:
-							self.historypos += 1
-							self.cursorpos = len(self.history[self.historypos])
-					elif self.escbuf == b'[C': # right
-						self.cursorpos += 1
-					elif self.escbuf == b'[D': # left
-						self.cursorpos -= 1
-					elif self.escbuf == b'[H': # home
-						self.cursorpos = 0
-					elif self.escbuf == b'[F': # end
-						self.cursorpos = len(self.history[self.historypos])
-					if self.cursorpos < 0:
-						self.cursorpos = 0
-					if self.cursorpos > len(self.history[self.historypos]):
-						self.cursorpos = len(self.history[self.historypos])
-					self.escbuf = b''
-					self.escmode = False
-					self.refresh()
+					data = Term.getkey()
+			finally:
+				DotPrinterSlots.release()
+			leftover = self.feed(data)
+			if leftover is not None:
+				Term.unget(leftover)
+				entered = True
+				break
+			keepGoing = process_all_input and self.readable()
+		DotPrinterSlots.refreshSlot(self)
+		return entered
+	def readable(self):
+		"""
+		Returns True if there's input waiting to be processed.
+		"""
+		if Term.pending() > 0:
+			return True
+		ifh, ofh, xfh = select.select([self.stdin.fileno()], [], [], 0)
+		return len(ifh) > 0
+	async def readline(self):
+		"""
+		asyncio-friendly way of running the line editor: waits (via
+		loop.add_reader(), without tying up the event loop) until the user
+		hits enter, then returns the line and reset()s for the next one.
+		"""
+		while True:
+			if not self.readable():
+				await Term.waitReadable(self.stdin.fileno())
+			if self.poll():
+				line = self.getBuf()
+				self.reset(history=self.history)
+				return line
+	def feed(self, data):
+		"""
+		Interprets a chunk of input bytes, updating the line being edited,
+		but doesn't redraw anything. Returns None, or, if the user hit
+		enter, whatever input came after the enter, as bytes.
+		"""
+		if len(data) < 1:
+			return None
+		self.lastbyte = data[-1:]
+		while len(data) > 0:
+			# Only parse up to the next line ending, so that if it turns out
+			# to be an enter, the rest can be handed back untouched. In the
+			# middle of a bracketed paste, parse up to the end of the paste
+			# instead, as a paste with line breaks in it hits enter too.
+			end = self.parser.paste_end_offset(data)
+			if end is None:
+				mat = _line_end_pat.search(data)
+				if mat is not None:
+					end = mat.end()
+			if end is None:
+				chunk, data = data, b''
 			else:
-				# UTF-8 black magic fuckery.
-				# Since we receive data from stdin one byte at a time, and
-				# UTF-8 characters may consist of more than one byte, we need
-				# some sort of provision to allow us to store intermediate
-				# bytes until we have a complete character. This here is that
-				# provision. Thankfully, due to the way that UTF-8 works, we
-				# can simply count the number of consecutive significant bits
-				# in each incoming byte, and if this number is greater than 1,
-				# subtracting 1 from that number will tell us how many
-				# additional bytes we need before that character is complete.
-				self.utf8buf += c
-				sigbits = count_significant_bits(ord(c))
-				if self.utf8bytesleft > 0:
-					self.utf8bytesleft -= 1
-				elif sigbits > 1:
-					self.utf8bytesleft = sigbits - 1
-				if self.utf8bytesleft == 0:
-					character = self.utf8buf.decode()
-					self.utf8buf = b''
-					# If we make any changes to the current line, we put the new
-					# contents here. This allows us to consolidate the "changed
-					# a line that isn't the last one in history? Make it a new
-					# history item" logic.
-					new_line = None
-					# Handle escape character.
-					if character == '\x1b':
-						self.escmode = True
-					# Handle backspace character.
-					elif character == '\x7f':
-						if self.cursorpos != 0:
-							new_line = self.history[self.historypos][:self.cursorpos - 1] + self.history[self.historypos][self.cursorpos:]
-							self.cursorpos -= 1
-					# Handle "ctrl+a" -- move cursor to start of line.
-					elif character == '\x01':
-						self.cursorpos = 0
-					# Handle "ctrl+d" -- end-of-file. Equivalent to CTRL+C,
-					# but only if the current line is empty.
-					elif character == '\x04':
-						if len(self.history[self.historypos]) == 0:
-							raise KeyboardInterrupt
-					# Handle "ctrl+e" -- move cursor to end of line.
-					elif character == '\x05':
-						self.cursorpos = len(self.history[self.historypos])
-					# Handle "ctrl+w" -- delete last word.
-					elif character == '\x17':
-						# Look at everything to the left of the cursor
-						active = self.history[self.historypos][:self.cursorpos]
-						mat = self.kill_word_pat.search(active)
-						if mat:
-							# If it matches our regex, then replace it with group 1
-							new = mat.group(1)
-						else:
-							# If it doesn't match, replace it with nothing
-							new = ''
-						# Build updated line by combinding our altered stuff with everything to the right of the cursor
-						new_line = new + self.history[self.historypos][self.cursorpos:]
-						# Update cursor position.
-						self.cursorpos = len(new)
-					# Ignore linefeed character.
-					elif character == '\x0a':
-						return True
-					# Note to myself: Why the holy hell did I have to add this in all of a sudden?
-					elif character == '\x0d':
-						return True
-					else:
-						new_line = self.history[self.historypos][:self.cursorpos] + character + self.history[self.historypos][self.cursorpos:]
-						self.cursorpos += 1
-					if new_line is not None:
-						if self.historypos != len(self.history) - 1:
-							# If not at the latest history position, go there.
-							# This has the effect of making the history copy-on-write.
-							# Which is desirable, because cows are desirable.
-							self.historypos = len(self.history) - 1
-						self.history[self.historypos] = new_line
-					self.refresh()
-
-			ifh, ofh, xfh = select.select([self.stdin.fileno()], [], [], 0)
-			keepGoing = len(ifh) > 0 and process_all_input
+				chunk, data = data[:end], data[end:]
+			for event in self.parser.parse(chunk):
+				if isinstance(event, str):
+					if self.feed_text(event):
+						return data
+				elif isinstance(event, frozenset):
+					self.feed_key(event)
+				elif isinstance(event, Paste):
+					rest = self.feed_paste(event.text)
+					if rest is not None:
+						self.lastbyte = b'\n'
+						return rest + data
+				elif isinstance(event, bytes) and event[-1:] in (b'\n', b'\r'):
+					# An escape sequence that got cut short by the user
+					# hitting enter.
+					self.lastbyte = event[-1:]
+					return data
+		return None
+	def feed_text(self, text):
+		"""
+		Handles a run of typed characters. Returns True if it ended with
+		the user hitting enter.
+		"""
+		pos = 0
+		for mat in self.control_pat.finditer(text):
+			if mat.start() > pos:
+				self.insert(text[pos:mat.start()])
+			pos = mat.end()
+			character = mat.group(0)
+			# Any changes to the current line go through self.edit() first,
+			# which consolidates the "changed a line that isn't the last
+			# one in history? Make it a new history item" logic.
+			# Handle backspace character.
+			if character == '\x7f':
+				if self.cursorpos != 0:
+					self.edit()
+					self.editbuf.delete(self.cursorpos - 1, self.cursorpos)
+					self.cursorpos -= 1
+			# Handle "ctrl+a" -- move cursor to start of line.
+			elif character == '\x01':
+				self.cursorpos = 0
+			# Handle "ctrl+d" -- end-of-file. Equivalent to CTRL+C,
+			# but only if the current line is empty.
+			elif character == '\x04':
+				if len(self.editbuf) == 0:
+					raise KeyboardInterrupt
+			# Handle "ctrl+e" -- move cursor to end of line.
+			elif character == '\x05':
+				self.cursorpos = len(self.editbuf)
+			# Handle "ctrl+w" -- delete last word.
+			elif character == '\x17':
+				# Look at everything to the left of the cursor
+				active = self.editbuf.slice(0, self.cursorpos)
+				mat = self.kill_word_pat.search(active)
+				if mat:
+					# If it matches our regex, then replace it with group 1
+					new = mat.group(1)
+				else:
+					# If it doesn't match, replace it with nothing
+					new = ''
+				# Chop out everything between our altered stuff and the cursor
+				self.edit()
+				self.editbuf.delete(len(new), self.cursorpos)
+				# Update cursor position.
+				self.cursorpos = len(new)
+			# Linefeed, or carriage return.
+			# Note to myself: Why the holy hell did I have to add carriage return in all of a sudden?
+			else:
+				self.lastbyte = character.encode()
+				return True
+		if pos < len(text):
+			self.insert(text[pos:])
 		return False
+	def feed_key(self, keys):
+		"""
+		Handles a key that arrived as an escape sequence.
+		"""
+		if keys == {'up arrow'}:
+			if self.historypos > 0:
+				self.goto_history(self.historypos - 1)
+				self.cursorpos = len(self.editbuf)
+		elif keys == {'down arrow'}:
+			if self.historypos < len(self.history) - 1:
+				self.goto_history(self.historypos + 1)
+				self.cursorpos = len(self.editbuf)
+		elif keys == {'right arrow'}:
+			self.cursorpos += 1
+		elif keys == {'left arrow'}:
+			self.cursorpos -= 1
+		elif keys == {'home'}:
+			self.cursorpos = 0
+		elif keys == {'end'}:
+			self.cursorpos = len(self.editbuf)
+		if self.cursorpos < 0:
+			self.cursorpos = 0
+		if self.cursorpos > len(self.editbuf):
+			self.cursorpos = len(self.editbuf)
+	def feed_paste(self, text):
+		"""
+		Handles a bracketed paste. Up to the first line break, it goes into
+		the line in one go, control characters and all. A line break hits
+		enter, same as it would without bracketed paste; in that case, the
+		rest of the paste is returned as bytes (rewrapped in bracketed paste
+		markers, if there's anything left of it) for feed() to hand back, so
+		each line gets submitted in turn. Otherwise returns None.
+		"""
+		lines = _paste_line_break_pat.split(text, 1)
+		self.insert(lines[0])
+		if len(lines) < 2:
+			return None
+		if len(lines[1]) < 1:
+			return b''
+		return paste_begin + lines[1].encode() + paste_end
+	def insert(self, text):
+		"""
+		Inserts text at the cursor.
+		"""
+		if len(text) < 1:
+			return
+		self.edit()
+		self.editbuf.insert(self.cursorpos, text)
+		self.cursorpos += len(text)
 	def line(self, *values, sep=' ', end='', file=None, printfile=True, **kwargs):
 		DotPrinterSlots.line(*values, sep=sep, end=end, file=file, printfile=printfile)
 		self.refresh()
@@ -1405,14 +3455,14 @@ class EditingLine(object):
 		DotPrinterSlots.lock()
 		DotPrinterSlots.deregister(self, msg)
 		DotPrinterSlots.release()
-		Term.revert()
+		if self.bracketed_paste:
+			Term.disableBracketedPaste(self.dotfile)
+		Term.endRawInput()
 	def activation_cb(self):
 		self.position_cursor()
-		Term.enableCursor()
-		self.dotfile.flush()
+		Term.enableCursor(self.dotfile)
 	def deactivation_cb(self):
-		Term.disableCursor()
-		self.dotfile.flush()
+		Term.disableCursor(self.dotfile)
 	def __del__(self):
 		pass
 		#if sys.meta_path is not None:
@@ -1440,8 +3490,10 @@ class Interpreter(EditingLine):
 			sys.stdout = origout
 		return (res, sio)
 	def poll(self):
-		resp = super().poll()
-		if resp:
+		# Run every line that's in, not just the first, since whatever came
+		# after an enter is waiting in Term's buffer, where select() won't
+		# see it.
+		while super().poll():
 			line = self.getBuf()
 			self.reset(history=self.history)
 			self.linebuf.append(line)
@@ -5,8 +5,15 @@ if __name__ == "__main__":
 	description = "Outputs terminal dimensions on STDOUT"
 	parser = argparse.ArgumentParser(description=description)
 	parser.add_argument('-g', '--getkey', action='store_true', dest='getkey', default=False, help="getkey mode: waits for a single character of input from the terminal, and returns that character on STDOUT")
+	parser.add_argument('--bench', action='store_true', dest='bench', default=False, help="Runs the render and input benchmarks, and outputs the results on STDOUT as JSON")
+	parser.add_argument('--bench-scale', action='store', type=float, dest='bench_scale', default=1.0, help="Multiplies the amount of work each benchmark does (default: %(default)s)")
 	args = parser.parse_args()
 
+	if args.bench:
+		from JaysTerm import bench
+		bench.main(scale=args.bench_scale)
+		sys.exit(0)
+
 	if args.getkey:
 		Term.init()
 		key = Term.getkey(interruptable=False)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""
+Benchmarks for JaysTerm's render and input hot paths.
+
+Run with:
+
+	python -m JaysTerm --bench
+
+Results come out on stdout as JSON, so they can be saved and compared
+across versions. Nothing is drawn on the real terminal: output goes to a
+ByteSink (see Term.setOutput()), and input comes in through a pty, so
+this works headless.
+"""
+
+import sys, os, time, json, pty, select, threading, platform
+import JaysTerm
+from JaysTerm import Term, DotPrinterSlots, DotPrinter, UpdatingLine, EditingLine, TerminalSequenceParser, ByteSink
+
+def result(name, ops, seconds, sink=None, **extra):# {{{
+	"""
+	Builds the record for one benchmark. If sink is given, bytes written
+	per operation are included too.
+	"""
+	ret = {
+		'name': name,
+		'ops': ops,
+		'seconds': seconds,
+		'ops_per_sec': ops / seconds if seconds > 0 else None,
+		'usec_per_op': seconds * 1000000 / ops if ops > 0 else None,
+	}
+	if sink is not None:
+		ret['bytes_per_op'] = sink.nbytes / ops if ops > 0 else None
+	ret.update(extra)
+	return ret
+# }}}
+def bench_dotprinter(count, colors=False, fps=None):# {{{
+	name = "DotPrinter.update"
+	if colors:
+		name += " colors"
+	if fps is not None:
+		name += " fps={}".format(fps)
+	try:
+		d = DotPrinter(count, showcount=True, label="bench", colors=colors)
+	except ImportError as e:
+		return {'name': name, 'skipped': str(e)}
+	DotPrinterSlots.setFps(fps)
+	sink = Term.stderr
+	sink.clear()
+	start = time.perf_counter()
+	for i in range(count):
+		d.update(i + 1)
+	elapsed = time.perf_counter() - start
+	ret = result(name, count, elapsed, sink)
+	d.close()
+	DotPrinterSlots.setFps(None)
+	return ret
+# }}}
+def bench_updatingline(count):# {{{
+	u = UpdatingLine()
+	texts = [ "processing item {} of {}".format(i, count) for i in range(count) ]
+	sink = Term.stderr
+	sink.clear()
+	start = time.perf_counter()
+	for text in texts:
+		u.update(text)
+	elapsed = time.perf_counter() - start
+	ret = result("UpdatingLine.update", count, elapsed, sink)
+	u.close()
+	return ret
+# }}}
+def bench_line(count, slots):# {{{
+	printers = [ DotPrinter(100, showcount=True, label="slot {}".format(i), colors=False) for i in range(slots) ]
+	for i, d in enumerate(printers):
+		d.update(i % 100)
+	sink = Term.stderr
+	sink.clear()
+	start = time.perf_counter()
+	for i in range(count):
+		DotPrinterSlots.line("log line {}".format(i))
+	elapsed = time.perf_counter() - start
+	ret = result("DotPrinterSlots.line slots={}".format(slots), count, elapsed, sink)
+	for d in printers:
+		d.close()
+	return ret
+# }}}
+def bench_textwidth(count):# {{{
+	ret = []
+	samples = [
+		("ascii", [ "plain ascii text {}".format(i) for i in range(count) ]),
+		("wide", [ "漢字とかなの文字列 {}".format(i) for i in range(count) ]),
+		("ansi", [ "\x1b[31mred\x1b[0m and \x1b[1mbold\x1b[0m {}".format(i) for i in range(count) ]),
+	]
+	for label, texts in samples:
+		JaysTerm.textwidth.cache_clear()
+		start = time.perf_counter()
+		for text in texts:
+			JaysTerm.textwidth(text)
+		elapsed = time.perf_counter() - start
+		ret.append(result("textwidth {}".format(label), count, elapsed))
+	return ret
+# }}}
+def bench_formatline(count):# {{{
+	ret = []
+	samples = [
+		("short", "short line"),
+		("long", "a fairly long line of plain text " * 20),
+		("ansi", "\x1b[32mgreen\x1b[0m 漢字 \x1b[1mbold\x1b[0m " * 20),
+	]
+	for label, text in samples:
+		for justify in ("left", "right"):
+			start = time.perf_counter()
+			for i in range(count):
+				JaysTerm.formatLine(text, 80, justify=justify)
+			elapsed = time.perf_counter() - start
+			ret.append(result("formatLine {} {}".format(label, justify), count, elapsed))
+	return ret
+# }}}
+def synthetic_input(nbytes):# {{{
+	"""
+	Makes up some typing: text, utf-8, arrow keys and backspaces, with no
+	line endings.
+	"""
+	pattern = "typing some text \x1b[D\x1b[Cmore wörds 漢字\x7f\x1b[1;5C\x1b[H\x1b[F".encode()
+	return (pattern * (nbytes // len(pattern) + 1))[:nbytes - nbytes % len(pattern)]
+# }}}
+def bench_parser(nbytes, chunk=4096):# {{{
+	data = synthetic_input(nbytes)
+	parser = TerminalSequenceParser(JaysTerm.InputDecoder())
+	start = time.perf_counter()
+	events = 0
+	for pos in range(0, len(data), chunk):
+		events += len(parser.parse(data[pos:pos + chunk]))
+	elapsed = time.perf_counter() - start
+	return result("TerminalSequenceParser.parse", len(data), elapsed, events=events, mb_per_sec=len(data) / elapsed / 1000000)
+# }}}
+def bench_editingline(nbytes, lines, master):# {{{
+	"""
+	Types lines of synthetic input into an EditingLine through the pty.
+	"""
+	line = synthetic_input(nbytes // lines) + b"\r"
+	e = EditingLine(history=[], stdin=Term.stdin, bracketed_paste=False)
+	# Writes to the pty can block once its buffer fills, so they're done
+	# from a thread.
+	writer = threading.Thread(target=lambda: [ os.write(master, line) for i in range(lines) ], daemon=True)
+	start = time.perf_counter()
+	writer.start()
+	done = 0
+	while done < lines:
+		if not e.readable():
+			select.select([Term.stdin.fileno()], [], [], 1)
+		if e.poll():
+			e.reset(history=[])
+			done += 1
+	elapsed = time.perf_counter() - start
+	writer.join()
+	e.close()
+	total = len(line) * lines
+	return result("EditingLine.poll pty", total, elapsed, lines=lines, mb_per_sec=total / elapsed / 1000000)
+# }}}
+def run(scale=1.0):# {{{
+	"""
+	Runs every benchmark, returning a dict with the results. scale
+	multiplies the amount of work done by each one.
+	"""
+	def n(x):
+		return max(1, int(x * scale))
+	# Input comes from a pty, output goes nowhere, and the "terminal" is
+	# always 80x24, so runs are comparable from machine to machine.
+	master, slave = pty.openpty()
+	Term.init(stdin=os.fdopen(slave, 'rb', buffering=0))
+	Term.setOutput(ByteSink(keep=False))
+	Term.fixed_size = Term.size = (80, 24)
+	results = []
+	results.append(bench_dotprinter(n(200000)))
+	results.append(bench_dotprinter(n(200000), colors=True))
+	results.append(bench_dotprinter(n(200000), fps=30))
+	results.append(bench_updatingline(n(50000)))
+	for slots in (1, 8, 32):
+		results.append(bench_line(n(5000), slots))
+	results.extend(bench_textwidth(n(100000)))
+	results.extend(bench_formatline(n(20000)))
+	results.append(bench_parser(n(4000000)))
+	results.append(bench_editingline(n(1000000), n(100), master))
+	os.close(master)
+	return {
+		'version': JaysTerm.__version__,
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'scale': scale,
+		'results': results,
+	}
+# }}}
+def main(scale=1.0, outfile=None):# {{{
+	results = run(scale)
+	if outfile is None:
+		outfile = sys.stdout
+	json.dump(results, outfile, indent=1)
+	outfile.write("\n")
+# }}}
+
+if __name__ == "__main__":
+	main()
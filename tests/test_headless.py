@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""
+Headless tests: output goes to a VirtualTerminal (see Term.setOutput()),
+and input comes in through a pty, so no real terminal is needed.
+
+Run with:
+
+	python -m unittest discover tests
+"""
+
+import os, pty, random, select, time, unittest
+import wcwidth
+from JaysTerm import Term, EditingLine, VirtualTerminal, ScreenLine, TerminalSequenceParser, InputDecoder, GapBuffer, Paste, text_cells, paste_begin, paste_end
+
+try:
+	# EditingLine needs it to measure its prompt.
+	import colors
+except ImportError:
+	colors = None
+
+master = None
+
+def setUpModule():# {{{
+	global master
+	master, slave = pty.openpty()
+	Term.init(stdin=os.fdopen(slave, 'rb', buffering=0))
+	# So that nothing, not even Term.cleanup() at exit, writes to the real
+	# stdout/stderr.
+	Term.setOutput(VirtualTerminal())
+# }}}
+def random_text(rng, maxlen):# {{{
+	"""
+	Makes up a line of text, with some double-width characters and colors
+	in it.
+	"""
+	ret = []
+	for i in range(rng.randrange(maxlen + 1)):
+		x = rng.random()
+		if x < 0.1:
+			ret.append(rng.choice(["\x1b[31m", "\x1b[1m", "\x1b[0m"]))
+		elif x < 0.25:
+			ret.append(rng.choice("漢字かな"))
+		else:
+			ret.append(rng.choice("abc xyz."))
+	return ''.join(ret)
+# }}}
+class ScreenLineTest(unittest.TestCase):# {{{
+	width = 20
+	def test_diff_matches_full_redraw(self):
+		rng = random.Random(1)
+		texts = [ random_text(rng, 30) for i in range(500) ]
+		# A double-width character straddling the right edge, and lines
+		# getting shorter.
+		texts += ["a" * (self.width - 1) + "漢", "abc", "", "漢" * self.width, "x"]
+		screen = ScreenLine()
+		diffed = VirtualTerminal(self.width, 1)
+		for text in texts:
+			cells = text_cells(text)
+			diffed.write(screen.render(cells, self.width))
+			full = VirtualTerminal(self.width, 1)
+			full.write(ScreenLine().render(cells, self.width))
+			self.assertEqual(diffed.line(0), full.line(0), repr(text))
+# }}}
+def normalize(events):# {{{
+	"""
+	Merges runs of text in a list of parser events, which can come out
+	split differently depending on how the input was chunked.
+	"""
+	ret = []
+	for x in events:
+		if isinstance(x, Paste):
+			x = ('paste', x.text)
+		if isinstance(x, str) and len(ret) > 0 and isinstance(ret[-1], str):
+			ret[-1] += x
+		else:
+			ret.append(x)
+	return ret
+# }}}
+class ParserTest(unittest.TestCase):# {{{
+	data = b"".join([
+		"plain wörds 漢字 ".encode(),
+		b"\x1b[A\x1b[B\x1b[1;5C\x1b[1;2D\x1bOP\x1b[H\x1b[F",
+		paste_begin + "pasted\nlines\x1b[A 漢\n".encode() + paste_end,
+		b"after\x1bxjunk\x1b[27;5;13~",
+		b"\x1b[200~\x1b[201~",
+		"tail ü".encode(),
+	])
+	def parse(self, chunks):
+		parser = TerminalSequenceParser(InputDecoder())
+		events = []
+		for chunk in chunks:
+			events += parser.parse(chunk)
+		return normalize(events)
+	def test_split_once(self):
+		whole = self.parse([self.data])
+		for i in range(1, len(self.data)):
+			self.assertEqual(self.parse([self.data[:i], self.data[i:]]), whole, i)
+	def test_byte_at_a_time(self):
+		whole = self.parse([self.data])
+		self.assertEqual(self.parse([ self.data[i:i + 1] for i in range(len(self.data)) ]), whole)
+	def test_random_splits(self):
+		whole = self.parse([self.data])
+		rng = random.Random(2)
+		for n in range(200):
+			cuts = sorted(rng.sample(range(1, len(self.data)), rng.randrange(1, 10)))
+			chunks = [ self.data[a:b] for a, b in zip([0] + cuts, cuts + [len(self.data)]) ]
+			self.assertEqual(self.parse(chunks), whole, cuts)
+# }}}
+class GapBufferTest(unittest.TestCase):# {{{
+	def check(self, buf, model):
+		self.assertEqual(str(buf), model)
+		self.assertEqual(len(buf), len(model))
+	def test_against_str(self):
+		rng = random.Random(3)
+		model = "start 漢字"
+		buf = GapBuffer(model, gap=4, widths=True)
+		for n in range(2000):
+			op = rng.random()
+			if op < 0.5:
+				pos = rng.randrange(len(model) + 1)
+				text = ''.join([ rng.choice("ab 漢字\x01") for i in range(rng.randrange(1, 12)) ])
+				buf.insert(pos, text)
+				model = model[:pos] + text + model[pos:]
+			elif op < 0.8:
+				start = rng.randrange(len(model) + 1)
+				end = rng.randrange(start, len(model) + 1)
+				buf.delete(start, end)
+				model = model[:start] + model[end:]
+			elif op < 0.98:
+				start = rng.randrange(len(model) + 1)
+				end = rng.randrange(start, len(model) + 1)
+				self.assertEqual(buf.slice(start, end), model[start:end])
+				pos = rng.randrange(len(model) + 1)
+				self.assertEqual(buf.width_to(pos), sum([ max(wcwidth.wcwidth(x), 0) for x in model[:pos] ]))
+			else:
+				model = model[:rng.randrange(len(model) + 1)]
+				buf.set(model)
+			self.check(buf, model)
+# }}}
+@unittest.skipIf(colors is None, "needs ansicolors")
+class EditingLineTest(unittest.TestCase):# {{{
+	def setUp(self):
+		self.vt = VirtualTerminal(40, 10)
+		Term.setOutput(self.vt)
+		self.line = EditingLine(history=[], stdin=Term.stdin)
+	def tearDown(self):
+		self.line.close()
+	def send(self, data):
+		os.write(master, data)
+		select.select([Term.fd], [], [], 1)
+		# Give the whole write time to land.
+		time.sleep(0.05)
+	def lines(self):
+		"""
+		Polls until the input runs out, returning the lines entered.
+		"""
+		ret = []
+		while self.line.readable():
+			if self.line.poll():
+				ret.append(self.line.getBuf())
+				self.line.reset(history=[])
+		return ret
+	def test_enter_with_leftover(self):
+		self.send(b"one\rtwo\rthr")
+		self.assertTrue(self.line.poll())
+		self.assertEqual(self.line.getBuf(), "one")
+		self.line.reset(history=[])
+		# What came after the enter is in Term's buffer, not the pty's.
+		self.assertGreater(Term.pending(), 0)
+		self.assertEqual(select.select([Term.fd], [], [], 0)[0], [])
+		self.assertTrue(self.line.readable())
+		self.assertEqual(self.lines(), ["two"])
+		self.assertEqual(self.line.getBuf(), "thr")
+		self.assertEqual(self.vt.line(0), "thr")
+	def test_paste_submits_each_line(self):
+		self.send(paste_begin + b"x = 6\ny = 7\nprint(x*y)\n" + paste_end + b"more")
+		self.assertEqual(self.lines(), ["x = 6", "y = 7", "print(x*y)"])
+		self.assertEqual(self.line.getBuf(), "more")
+	def test_paste_without_line_breaks(self):
+		self.send(b"a " + paste_begin + b"b\x01c" + paste_end + b" d\r")
+		self.assertEqual(self.lines(), ["a b\x01c d"])
+# }}}
+
+if __name__ == "__main__":
+	unittest.main()